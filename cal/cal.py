@@ -1,175 +1,525 @@
+import argparse
 import toml
-from threading import Thread, Lock
+from threading import Thread
+from collections import namedtuple
 import icalendar
 import recurring_ical_events
-from datetime import datetime
+from datetime import date, datetime, timedelta
 from tzlocal import get_localzone
 from dateutil import relativedelta
 import time
 import requests
-from copy import deepcopy
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from bisect import bisect_left
+from hashlib import md5
+from operator import attrgetter, itemgetter
+import json
 import logging
-
-def _get_calendar(source):
-    if source.startswith('http'):
-        return _get_calendar_http(source)
+import math
+import multiprocessing
+import os
+import pickle
+import tracemalloc
+
+CACHE_DIR = '.cache/calendar'
+
+# Defaults for the per-calendar settings, in seconds: how often to refresh,
+# how long to wait for a server, and the first wait after a failure.
+# Waits after repeated failures double up to MAX_BACKOFF.
+DEFAULT_REFRESH = 600
+DEFAULT_TIMEOUT = 30
+DEFAULT_BACKOFF = 60
+MAX_BACKOFF = 3600
+
+# Days of events shown, and days of recurrences expanded in one go
+WINDOW_DAYS = 7
+EXPANSION_DAYS = 35
+ONE_DAY = timedelta(days=1)
+
+# The published state of one calendar. Snapshots are never changed once
+# published; the fetcher replaces them.
+calendar_snapshot = namedtuple('calendar_snapshot', ['error', 'data'])
+
+# Events must end less than this many days ago to be kept when parsing.
+# Anything older can never be shown again.
+PAST_DAYS = 2
+
+# Events with these properties are recurrences or overrides of them
+RECURRENCE_PROPERTIES = {'RRULE', 'RDATE', 'RECURRENCE-ID'}
+
+# Split a stream of text chunks into lines
+def _split_lines(chunks):
+    partial = ''
+    for chunk in chunks:
+        lines = (partial + chunk).split('\n')
+        partial = lines.pop()
+        yield from lines
+
+    if len(partial) > 0:
+        yield partial
+
+# Whether a VEVENT, given as its content lines, ended before the cutoff
+# (a YYYYMMDD string). Recurring events and their overrides are never
+# counted as ended, nor are events whose end can't be read from the text.
+def _ended_before(lines, cutoff):
+    unfolded = []
+    for line in lines:
+        if line[:1] in (' ', '\t') and len(unfolded) > 0:
+            unfolded[-1] += line[1:]
+        else:
+            unfolded.append(line)
+
+    times = dict()
+    for line in unfolded:
+        name = line.split(':', 1)[0].split(';', 1)[0].upper()
+        if name in RECURRENCE_PROPERTIES:
+            return False
+        if name in ('DTSTART', 'DTEND', 'DURATION'):
+            times[name] = line.rpartition(':')[2].strip()
+
+    if 'DTEND' in times:
+        end = times['DTEND']
+    elif 'DTSTART' in times and 'DURATION' not in times:
+        end = times['DTSTART']
     else:
-        return _get_calendar_file(source)
+        return False
+
+    return len(end) >= 8 and end[:8].isdigit() and end[:8] < cutoff
+
+# Parse a calendar from its lines, one VEVENT at a time, dropping events
+# that have already ended before building any objects.
+# Returns (the kept text, calendar).
+def _parse_calendar(lines):
+    cutoff = (date.today() - timedelta(days=PAST_DAYS)).strftime('%Y%m%d')
+
+    kept = []
+    event = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if event is None:
+            if line.upper() == 'BEGIN:VEVENT':
+                event = [line]
+            else:
+                kept.append(line)
+        else:
+            event.append(line)
+            if line.upper() == 'END:VEVENT':
+                if not _ended_before(event, cutoff):
+                    kept.extend(event)
+                event = None
+
+    # An unfinished event is left for the parser to complain about
+    if event is not None:
+        kept.extend(event)
+
+    text = '\r\n'.join(kept) + '\r\n'
+    return (text, icalendar.Calendar.from_ical(text))
+
+# A local file's (modification time, size), or None if it can't be read
+def _file_signature(source):
+    try:
+        stat = os.stat(source)
+        return (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return None
 
 def _get_calendar_file(source):
-    with open(source) as f:
-        return icalendar.Calendar.from_ical(f.read())
-
-def _get_calendar_http(source):
-    req = requests.get(source)
-    return icalendar.Calendar.from_ical(req.text)
+    with open(source, newline='') as f:
+        return _parse_calendar(f)[1]
+
+# Fetch a calendar over HTTP, sending the validators from the last fetch.
+# Returns (kept text, calendar, validators), or None if it hasn't changed.
+def _get_calendar_http(session, source, validators, timeout):
+    headers = dict()
+    if 'etag' in validators:
+        headers['If-None-Match'] = validators['etag']
+    if 'last_modified' in validators:
+        headers['If-Modified-Since'] = validators['last_modified']
+
+    req = session.get(source, headers=headers, timeout=timeout, stream=True)
+    if req.status_code == 304:
+        req.close()
+        return None
+
+    req.raise_for_status()
+
+    new_validators = dict()
+    if 'ETag' in req.headers:
+        new_validators['etag'] = req.headers['ETag']
+    if 'Last-Modified' in req.headers:
+        new_validators['last_modified'] = req.headers['Last-Modified']
+
+    # Read the calendar as it arrives rather than as one string
+    if req.encoding is None:
+        req.encoding = 'utf-8'
+    (raw, cal) = _parse_calendar(_split_lines(req.iter_content(chunk_size=65536, decode_unicode=True)))
+
+    return (raw, cal, new_validators)
+
+def _write_atomic(path, mode, content):
+    with open(f'{path}.tmp', mode) as f:
+        f.write(content)
+    os.replace(f'{path}.tmp', path)
+
+# The raw text, parsed calendar and HTTP validators of each calendar
+# source, kept on disk so a restart can show events straight away
+class calendar_cache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, source, extension):
+        return os.path.join(self.cache_dir, f'{md5(source.encode("utf-8")).hexdigest()}.{extension}')
+
+    # Returns (calendar, validators), or (None, {}) if nothing is cached
+    def load(self, source):
+        try:
+            with open(self._path(source, 'json')) as f:
+                validators = json.load(f)
+
+            try:
+                with open(self._path(source, 'pickle'), 'rb') as f:
+                    return (pickle.load(f), validators)
+            except Exception:
+                with open(self._path(source, 'ics')) as f:
+                    return (icalendar.Calendar.from_ical(f.read()), validators)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.error(f'Error reading cached calendar {source}')
+            logging.error(e)
+
+        return (None, dict())
+
+    def save(self, source, raw, calendar, validators):
+        try:
+            _write_atomic(self._path(source, 'ics'), 'w', raw)
+            _write_atomic(self._path(source, 'pickle'), 'wb', pickle.dumps(calendar))
+            _write_atomic(self._path(source, 'json'), 'w', json.dumps(validators))
+        except Exception as e:
+            logging.error(f'Error caching calendar {source}')
+            logging.error(e)
 
 
 def midnight(date_object):
     return date_object.replace(hour=0, minute=0, second=0, microsecond=0)
 
+# Epoch seconds for an event time. Dates are local midnight, as are
+# datetimes without a zone.
+def _time_key(value, zone):
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=zone)
+    return value.timestamp()
+
+# Expand a calendar's recurrences over a horizon into sorted
+# (start key, end key, summary, start, end) tuples. This can run in a
+# worker process, and the tuples are far smaller to send back than the
+# expanded components.
+def expand_events(calendar, start, end):
+    zone = get_localzone()
+    events = []
+    for ev in recurring_ical_events.of(calendar).between(start, end):
+        event_start = ev.get('dtstart').dt
+        event_end = ev.get('dtend').dt
+        summary = ev.get('summary')
+        if summary is not None:
+            summary = str(summary)
+        events.append((_time_key(event_start, zone), _time_key(event_end, zone), summary, event_start, event_end))
+
+    events.sort(key=lambda event: event[0])
+    return events
+
+# The expansion horizon for a window starting now
+def expansion_horizon(now):
+    horizon_start = midnight(now)
+    return (horizon_start, horizon_start + relativedelta.relativedelta(days=EXPANSION_DAYS))
+
+# A time in the local zone. Times without a zone are taken as local.
+def _local_time(value, zone):
+    if value.tzinfo is None:
+        return value.replace(tzinfo=zone)
+    return value.astimezone(zone)
+
+# An event as shown. For timed events start and end are local times and
+# time_to_start is how long until it starts. For all day events start and
+# end are the first and last days, and time_to_start is None.
+class calendar_event:
+    __slots__ = ('name', 'color', 'start', 'end', 'time_to_start')
+
+    def __init__(self, name, color, start, end, time_to_start):
+        self.name = name
+        self.color = color
+        self.start = start
+        self.end = end
+        self.time_to_start = time_to_start
+
+# One version of a calendar with its recurrences expanded over a horizon.
+# Events are sorted by start, and with the longest event's duration
+# known, the events overlapping a window can be found by binary search.
+# The events can be passed in if they were expanded elsewhere.
+class expanded_calendar:
+    def __init__(self, calendar, start, end, events=None):
+        self.calendar = calendar
+        self.start = start
+        self.end = end
+
+        if events is None:
+            events = expand_events(calendar, start, end)
+
+        self.starts = [event[0] for event in events]
+        self.events = events
+        self.max_duration = max([event[1] - event[0] for event in events], default=0)
+
+    def covers(self, calendar, start, end):
+        return calendar is self.calendar and self.start <= start and end <= self.end
+
+    # The (summary, start, end) of events overlapping the window
+    def between(self, start, end):
+        start_key = start.timestamp()
+        end_key = end.timestamp()
+
+        first = bisect_left(self.starts, start_key - self.max_duration)
+        last = bisect_left(self.starts, end_key)
+
+        return [(summary, event_start, event_end) for (key, end_time, summary, event_start, event_end) in self.events[first:last]
+            if end_time > start_key or key >= start_key]
+
 
 class cal(Thread):
     def __init__(self, config):
-        self.calendars = config
+        # Calendars are the [calendar.*] tables; other keys are settings
+        self.calendars = {name: entry for (name, entry) in config.items() if isinstance(entry, dict)}
         self.stop_flag = False
+
+        # calendar_snapshots by name. Only the fetcher thread publishes, by
+        # swapping in a new dict, so readers take the reference and need no lock.
         self.calendar_data = dict()
-        self.lock = Lock()
-        self.output_time = None
-        self.output = None
+
+        # The expanded_calendar for each calendar, used by get_events.
+        # With expansion_workers set, calendars are expanded ahead of time
+        # in that many processes instead of on demand in get_events, which
+        # shows the previous expansion until the new one arrives.
+        self.expansions = dict()
+        self.expansion_workers = config.get('expansion_workers', 0)
+
+        # One pooled session for all HTTP calendars, and the HTTP
+        # validators for conditional requests
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=max(1, len(self.calendars)))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.validators = dict()
+
+        # When each calendar is next due, and its failures in a row
+        self.next_fetch = {name: 0 for name in self.calendars.keys()}
+        self.failures = {name: 0 for name in self.calendars.keys()}
+
+        # The file signature of each local calendar when it was last read.
+        # Local calendars are read again as soon as they change, and
+        # otherwise only to retry after a failure.
+        self.file_signatures = dict()
+
+        # Start with whatever was cached by the last run
+        self.cache = calendar_cache(config.get('cache_dir', CACHE_DIR))
+        cached_data = dict()
+        for name in self.calendars.keys():
+            source = self.calendars[name]['calendar']
+            if source.startswith('http'):
+                (cached, validators) = self.cache.load(source)
+                if cached is not None:
+                    cached_data[name] = calendar_snapshot(False, cached)
+                    self.validators[name] = validators
+        self.calendar_data = cached_data
 
         Thread.__init__(self)
         self.start()
 
+    # Fetch every calendar that's due in its own worker, so a slow server
+    # only holds up its own calendar
     def run(self):
+        executor = ThreadPoolExecutor(max_workers=max(1, len(self.calendars)))
+        in_flight = dict()
+
+        # Spawn rather than fork the workers, since this process has other
+        # threads running. Programs using this must have a __main__ guard.
+        expander = None
+        expanding = dict()
+        if self.expansion_workers > 0:
+            expander = ProcessPoolExecutor(max_workers=self.expansion_workers,
+                mp_context=multiprocessing.get_context('spawn'))
+
         while not self.stop_flag:
-            for name in self.calendars.keys():
-                if self.stop_flag:
-                    break
+            for name in list(in_flight.keys()):
+                if in_flight[name].done():
+                    self._store_calendar(name, in_flight.pop(name))
 
-                cal_valid = True
-                cal = None
+            now = time.monotonic()
+            for name in self.calendars.keys():
+                if name not in in_flight and (now >= self.next_fetch[name] or self._file_changed(name)):
+                    in_flight[name] = executor.submit(self._get_calendar, name)
+
+            if expander is not None:
+                self._expand_calendars(expander, expanding)
+
+            time.sleep(1)
+
+        executor.shutdown(wait=False, cancel_futures=True)
+        if expander is not None:
+            expander.shutdown(wait=False, cancel_futures=True)
+
+    # Collect finished expansions, and start one for each calendar whose
+    # expansion is out of date. expanding holds (future, calendar, start, end)
+    # for each calendar being expanded.
+    def _expand_calendars(self, expander, expanding):
+        for name in list(expanding.keys()):
+            (future, calendar, start, end) = expanding[name]
+            if future.done():
+                del expanding[name]
                 try:
-                    cal = _get_calendar(self.calendars[name]['calendar'])
+                    self.expansions[name] = expanded_calendar(calendar, start, end, future.result())
                 except Exception as e:
-                    cal_valid = False
-                    logging.error(f'Error getting calendar {name}')
+                    logging.error(f'Error expanding calendar {name}')
                     logging.error(e)
 
-                with self.lock:
-                    if name not in self.calendar_data.keys() or cal_valid:
-                        self.calendar_data[name] = {'error': not cal_valid, 'data': cal}
-                    else:
-                        self.calendar_data[name]['error'] = not cal_valid
-
-            sleep_time = 0
-            while not self.stop_flag and sleep_time < 600:
-                time.sleep(1)
-                sleep_time += 1
-
+        now = datetime.now(get_localzone())
+        window_end = now + relativedelta.relativedelta(days=WINDOW_DAYS)
+        for (name, snapshot) in self.calendar_data.items():
+            if snapshot.data is None:
+                continue
+
+            if name in expanding:
+                # Already expanding this version
+                if expanding[name][1] is snapshot.data:
+                    continue
+                expanding[name][0].cancel()
+
+            expansion = self.expansions.get(name)
+            if expansion is None or not expansion.covers(snapshot.data, now, window_end):
+                (start, end) = expansion_horizon(now)
+                expanding[name] = (expander.submit(expand_events, snapshot.data, start, end), snapshot.data, start, end)
+
+    def _store_calendar(self, name, future):
+        settings = self.calendars[name]
+
+        cal_valid = True
+        cal = None
+        try:
+            cal = future.result()
+        except Exception as e:
+            cal_valid = False
+            logging.error(f'Error getting calendar {name}')
+            logging.error(e)
+
+        if cal_valid:
+            self.failures[name] = 0
+            wait = settings.get('refresh', DEFAULT_REFRESH) if settings['calendar'].startswith('http') else math.inf
+        else:
+            self.failures[name] += 1
+            wait = min(settings.get('backoff', DEFAULT_BACKOFF) * 2 ** (self.failures[name] - 1), MAX_BACKOFF)
+        self.next_fetch[name] = time.monotonic() + wait
+
+        # Copy on write: readers keep whichever dict they already have
+        calendar_data = dict(self.calendar_data)
+        if cal is not None or name not in calendar_data.keys():
+            calendar_data[name] = calendar_snapshot(not cal_valid, cal)
+        else:
+            calendar_data[name] = calendar_data[name]._replace(error=not cal_valid)
+        self.calendar_data = calendar_data
+
+    def _file_changed(self, name):
+        source = self.calendars[name]['calendar']
+        return not source.startswith('http') and _file_signature(source) != self.file_signatures.get(name)
+
+    # Get a calendar's latest data, or None if it hasn't changed
+    def _get_calendar(self, name):
+        source = self.calendars[name]['calendar']
+        if not source.startswith('http'):
+            # Taken before reading, so a change part way through is seen next time
+            self.file_signatures[name] = _file_signature(source)
+            return _get_calendar_file(source)
+
+        # Only ask for changes if there's data to fall back on
+        validators = self.validators.get(name, dict()) if name in self.calendar_data.keys() else dict()
+
+        result = _get_calendar_http(self.session, source, validators, self.calendars[name].get('timeout', DEFAULT_TIMEOUT))
+        if result is None:
+            return None
+
+        (raw, cal, validators) = result
+        self.validators[name] = validators
+        self.cache.save(source, raw, cal, validators)
+        return cal
+
+    # The events to show, as (day, calendar_event) pairs in display order,
+    # from today to WINDOW_DAYS ahead. An all day event is listed under each
+    # of its days, all sharing one calendar_event.
     def get_events(self):
-
-        if self.output is None or (datetime.now() - self.output_time).total_seconds() >= 15:
-
-            day_events = []
-            time_events = []
-            now = datetime.now(get_localzone())
-            cal_period = now + relativedelta.relativedelta(days=7)
-
-            with self.lock:
-                for name in self.calendar_data.keys():
-                    cal = self.calendar_data[name]['data']
-                    if cal is not None:
-                        events = recurring_ical_events.of(cal).between(now, cal_period)
-                        for ev in events:
-                            event = {
-                                'name': ev.get('summary'),
-                                'start': ev.get('dtstart').dt,
-                                'end': ev.get('dtend').dt,
-                                'color': self.calendars[name]['color']
-                            }
-
-                            if isinstance(event['start'], datetime):
-                                time_events.append(event)
-                            else:
-                                start_date = event['start']
-                                end_date = event['end']
-
-                                current_date = event['start']
-                                while current_date < end_date:
-
-                                    if current_date >= midnight(now).date():
-                                        day_event = deepcopy(event)
-                                        day_event['start'] = current_date
-                                        day_event['end'] = current_date
-
-                                        day_events.append(day_event)
-
-                                    current_date = current_date + relativedelta.relativedelta(days=1)
-
-            day_events = sorted(day_events, key=lambda x: x['start'])
-            time_events = sorted(time_events, key=lambda x: x['start'])
-
-            result = []
-
-            current_date = midnight(datetime.now(get_localzone())).date()
-            day_event_index = 0
-            time_event_index = 0
-
-            while day_event_index < len(day_events) or time_event_index < len(time_events):
-                while day_event_index < len(day_events) and day_events[day_event_index]['start'] <= current_date:
-                    evt = day_events[day_event_index]
-
-                    event_object = {
-                        'start': evt['start'],
-                        'name': evt['name'],
-                        'color': evt['color'],
-                        'time_to_start': None
-                    }
-
-                    true_end = evt['end'] - relativedelta.relativedelta(days = 1)
-                    if true_end == evt['start']:
-                        event_object['end'] = None
+        zone = get_localzone()
+        now = datetime.now(zone)
+        today = now.date()
+        last_day = today + timedelta(days=WINDOW_DAYS)
+        cal_period = now + relativedelta.relativedelta(days=WINDOW_DAYS)
+
+        day_rows = []
+        time_events = []
+
+        for (name, snapshot) in self.calendar_data.items():
+            cal = snapshot.data
+            if cal is not None:
+                expansion = self.expansions.get(name)
+                if expansion is None or (self.expansion_workers == 0 and not expansion.covers(cal, now, cal_period)):
+                    # Not expanded ahead of time, so do it here
+                    (start, end) = expansion_horizon(now)
+                    expansion = expanded_calendar(cal, start, end)
+                    self.expansions[name] = expansion
+
+                color = self.calendars[name]['color']
+                for (summary, start, end) in expansion.between(now, cal_period):
+                    if isinstance(start, datetime):
+                        start = _local_time(start, zone)
+                        time_events.append(calendar_event(summary, color, start, _local_time(end, zone), start - now))
                     else:
-                        event_object['end'] = true_end
+                        event = calendar_event(summary, color, start, end - ONE_DAY, None)
+                        day = max(start, today)
+                        while day < end and day <= last_day:
+                            day_rows.append((day, event))
+                            day += ONE_DAY
 
-                    result.append(event_object)
+        day_rows.sort(key=itemgetter(0))
+        time_events.sort(key=attrgetter('start'))
 
-                    day_event_index += 1
+        result = []
 
-                while time_event_index < len(time_events) and midnight(time_events[time_event_index]['start']).date() <= current_date:
-                    evt = time_events[time_event_index]
+        current_date = today
+        day_index = 0
+        time_index = 0
 
-                    event_object = {
-                        'start': evt['start'].astimezone(get_localzone()),
-                        'end': evt['end'].astimezone(get_localzone()),
-                        'name': evt['name'],
-                        'color': evt['color'],
-                        'time_to_start': evt['start'].astimezone(get_localzone()) - datetime.now(get_localzone())
-                    }
+        while current_date <= last_day and (day_index < len(day_rows) or time_index < len(time_events)):
+            while day_index < len(day_rows) and day_rows[day_index][0] <= current_date:
+                result.append(day_rows[day_index])
+                day_index += 1
 
-                    result.append(event_object)
+            while time_index < len(time_events) and time_events[time_index].start.date() <= current_date:
+                event = time_events[time_index]
+                result.append((event.start.date(), event))
+                time_index += 1
 
-                    time_event_index += 1
+            current_date += ONE_DAY
 
-                current_date = current_date + relativedelta.relativedelta(days=1)
-                if (current_date - now.date()).days > 7:
-                    break
-
-            self.output = result
-            self.output_time = datetime.now()
-
-        return self.output
+        return result
 
     def has_error(self):
         has_error = False
 
-        with self.lock:
-            for name in self.calendars.keys():
-                if name in self.calendar_data.keys():
-                    if self.calendar_data[name]['error']:
-                        has_error = True
-                        break
+        calendar_data = self.calendar_data
+        for name in self.calendars.keys():
+            if name in calendar_data.keys():
+                if calendar_data[name].error:
+                    has_error = True
+                    break
 
         return has_error
 
@@ -178,14 +528,56 @@ class cal(Thread):
 
 
 
-# Run from parent directory, i.e. python calendar/calendar.py
+# Time get_events over the given calendar files, and measure the memory
+# it allocates: the peak while it runs and what the result holds on to
+def benchmark(files, repeat):
+    calendars = {f'calendar{index}': {'calendar': source, 'color': 'white'} for (index, source) in enumerate(files)}
+    instance = cal(calendars)
+    while len(instance.calendar_data) < len(files):
+        time.sleep(0.1)
+    instance.stop()
+
+    # Expand once up front, as the display loop would have
+    events = instance.get_events()
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        events = instance.get_events()
+    elapsed = (time.perf_counter() - start) / repeat
+
+    events = None
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    events = instance.get_events()
+    (after, peak) = tracemalloc.get_traced_memory()
+    blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.stop()
+
+    print(f'{len(events)} rows, {elapsed * 1000:.2f}ms per call')
+    print(f'{(peak - before) / 1024:.0f}KiB peak, {(after - before) / 1024:.0f}KiB in {blocks} blocks held by the result')
+
+    instance.join()
+
+
+# Run from parent directory, i.e. python cal/cal.py
 if __name__ == "__main__":
-    with open('config.toml') as config_file:
-        config = toml.load(config_file)
+    arg_parser = argparse.ArgumentParser(prog='Calendar')
+    subparsers = arg_parser.add_subparsers(dest='command')
+    benchmark_parser = subparsers.add_parser('benchmark', help='Measure get_events')
+    benchmark_parser.add_argument('--repeat', type=int, default=20, help='Number of calls to time')
+    benchmark_parser.add_argument('files', nargs='+', help='Calendar files')
+
+    args = arg_parser.parse_args()
 
-    instance = cal(config['calendar'])
+    if args.command == 'benchmark':
+        benchmark(args.files, args.repeat)
+    else:
+        with open('config.toml') as config_file:
+            config = toml.load(config_file)
 
-    while True:
-        print(instance.get_result())
-        time.sleep(5)
+        instance = cal(config['calendar'])
 
+        while True:
+            for (day, event) in instance.get_events():
+                print(day, event.start, event.name)
+            time.sleep(5)
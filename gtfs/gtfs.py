@@ -1,16 +1,293 @@
+import argparse
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import requests
+from operator import attrgetter
+from pathlib import Path
+import re
+import resource
 import sqlite3
-import pandas as pd
+import subprocess
+import sys
 from datetime import date, datetime, timedelta
 from threading import Thread
 import time
 import toml
 
+# Seconds between attempts to extract days that failed
+RETRY_INTERVAL = 300
+
+# Seconds between polls of GTFS-Realtime sources
+REALTIME_INTERVAL = 30
+REALTIME_TIMEOUT = 10
+
+# The trip details kept for building journeys
+trip_row = namedtuple('trip_row', ['timestamp', 'color', 'route', 'destination', 'trip_id', 'stop_id', 'stop_sequence', 'date'])
+
+# The most connecting journeys to search for on each update
+CONNECTING_JOURNEYS = 10
+
+# A GTFS-Realtime TripUpdate, reduced to what's needed to delay trips
+trip_update = namedtuple('trip_update', ['start_date', 'delay', 'cancelled', 'stops'])
+stop_update = namedtuple('stop_update', ['stop_sequence', 'stop_id', 'delay', 'time', 'skipped'])
+
+# PRAGMA user_version values written by prepare_database: 1 for an integer
+# stop_sequence, 2 for the active_services table as well
+SEQUENCE_VERSION = 1
+SERVICES_VERSION = 2
+PREPARED_VERSION = SERVICES_VERSION
+
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+# Indexes needed by the trips query, as (name, table, columns)
+TRIP_INDEXES = [
+    ('stop_times_stop_id', 'stop_times', 'stop_id'),
+    ('stop_times_trip_sequence', 'stop_times', 'trip_id, stop_sequence'),
+    ('calendar_dates_date_service', 'calendar_dates', 'date, service_id'),
+    ('trips_trip_id', 'trips', 'trip_id'),
+    ('trips_service_id', 'trips', 'service_id'),
+    ('routes_route_id', 'routes', 'route_id'),
+    ('stops_stop_id', 'stops', 'stop_id')
+]
+
 # Make parameters for an IN clause
 def make_in_params(count):
     return ','.join([ '?' ] * count)
 
+# The join onto the services running on each date, and any extra condition it needs
+def make_service_join(version):
+    if version >= SERVICES_VERSION:
+        return ('INNER JOIN active_services c ON c.service_id = t.service_id ', '')
+    else:
+        return ('INNER JOIN calendar_dates c ON c.service_id = t.service_id ', 'AND c.exception_type = 1 ')
+
+# Build the trips query. Prepared databases store stop_sequence as an
+# integer, so the comparison can be made directly on the index, and
+# have the services running on each date in active_services.
+def make_trip_query(departure_count, arrival_count, date_count, version=0):
+    if version >= SEQUENCE_VERSION:
+        sequence_check = 'st2.stop_sequence > st1.stop_sequence '
+    else:
+        sequence_check = 'CAST(st2.stop_sequence AS INTEGER) > CAST(st1.stop_sequence AS INTEGER) '
+
+    (service_join, service_check) = make_service_join(version)
+
+    return (
+        'SELECT st1.trip_id, st1.stop_id, s.stop_name, r.route_short_name AS route, t.trip_headsign AS destination, '
+        'r.route_color as color, c.date, st1.departure_time, st1.stop_sequence '
+        'FROM stop_times st1 INNER JOIN stop_times st2 ON st1.trip_id = st2.trip_id '
+        'INNER JOIN stops s ON s.stop_id = st1.stop_id '
+        'INNER JOIN trips t ON t.trip_id = st1.trip_id '
+        'INNER JOIN routes r ON t.route_id = r.route_id '
+        f'{service_join}'
+        f'WHERE st1.stop_id IN ({make_in_params(departure_count)}) AND st2.stop_id IN ({make_in_params(arrival_count)}) '
+        f'AND {sequence_check}'
+        f'{service_check}'
+        f'AND c.date IN ({make_in_params(date_count)}) '
+        'ORDER BY c.date, st1.departure_time'
+        )
+
+# Build the query for every stop time on the given dates, in trip order
+def make_connection_query(date_count, version=0):
+    if version >= SEQUENCE_VERSION:
+        sequence = 'st.stop_sequence'
+    else:
+        sequence = 'CAST(st.stop_sequence AS INTEGER)'
+
+    (service_join, service_check) = make_service_join(version)
+
+    return (
+        'SELECT c.date, st.trip_id, st.stop_id, s.stop_name, st.arrival_time, st.departure_time, '
+        'r.route_short_name AS route, t.trip_headsign AS destination, r.route_color AS color '
+        'FROM trips t '
+        f'{service_join}'
+        'INNER JOIN stop_times st ON st.trip_id = t.trip_id '
+        'INNER JOIN stops s ON s.stop_id = st.stop_id '
+        'INNER JOIN routes r ON t.route_id = r.route_id '
+        f'WHERE c.date IN ({make_in_params(date_count)}) '
+        f'{service_check}'
+        f'ORDER BY c.date, st.trip_id, {sequence}'
+        )
+
+def connect_read_only(db_file):
+    return sqlite3.connect(f'{Path(db_file).absolute().as_uri()}?mode=ro', uri=True)
+
+def get_version(con):
+    return con.execute('PRAGMA user_version').fetchone()[0]
+
+# Parts of a table definition that can't be read back through the PRAGMAs,
+# so are lost when stop_times is rebuilt
+UNKEPT_CLAUSES = ['CHECK', 'COLLATE', 'GENERATED', 'AUTOINCREMENT']
+
+def _quote_columns(names):
+    return ', '.join(f'"{name}"' for name in names)
+
+# Rebuild stop_times so that stop_sequence has INTEGER affinity. Column
+# NOT NULL and DEFAULT settings, the PRIMARY KEY, UNIQUE and FOREIGN KEY
+# constraints, and the table's own indexes and triggers are kept.
+# Returns None if the table didn't need rebuilding, or else the
+# UNKEPT_CLAUSES that were in its old definition.
+def _integer_stop_sequence(con):
+    columns = con.execute('PRAGMA table_info(stop_times)').fetchall()
+    for column in columns:
+        if column[1] == 'stop_sequence' and column[2].upper() == 'INTEGER':
+            return None
+
+    table_sql = con.execute('SELECT sql FROM sqlite_master WHERE type = \'table\' AND name = \'stop_times\'').fetchone()[0]
+
+    definitions = []
+    column_selects = []
+    for (_, name, column_type, not_null, default, _) in columns:
+        if name == 'stop_sequence':
+            definition = '"stop_sequence" INTEGER'
+            column_selects.append('CAST("stop_sequence" AS INTEGER)')
+        else:
+            definition = f'"{name}" {column_type}'
+            column_selects.append(f'"{name}"')
+        if not_null:
+            definition += ' NOT NULL'
+        if default is not None:
+            definition += f' DEFAULT ({default})'
+        definitions.append(definition)
+
+    primary_key = [column[1] for column in sorted(columns, key=lambda column: column[5]) if column[5] > 0]
+    if len(primary_key) > 0:
+        definitions.append(f'PRIMARY KEY ({_quote_columns(primary_key)})')
+
+    for index in con.execute('PRAGMA index_list(stop_times)').fetchall():
+        if index[3] == 'u':
+            unique = [info[2] for info in con.execute(f'PRAGMA index_info("{index[1]}")')]
+            definitions.append(f'UNIQUE ({_quote_columns(unique)})')
+
+    foreign_keys = dict()
+    for (key_id, _, table, from_column, to_column, on_update, on_delete, _) in con.execute('PRAGMA foreign_key_list(stop_times)'):
+        foreign_keys.setdefault(key_id, (table, [], [], on_update, on_delete))
+        foreign_keys[key_id][1].append(from_column)
+        foreign_keys[key_id][2].append(to_column)
+    for (table, from_columns, to_columns, on_update, on_delete) in foreign_keys.values():
+        references = f'"{table}"' if None in to_columns else f'"{table}" ({_quote_columns(to_columns)})'
+        definitions.append(f'FOREIGN KEY ({_quote_columns(from_columns)}) REFERENCES {references} '
+            f'ON UPDATE {on_update} ON DELETE {on_delete}')
+
+    options = ' WITHOUT ROWID' if re.search(r'\)\s*WITHOUT\s+ROWID\s*;?\s*$', table_sql, re.IGNORECASE) else ''
+
+    # CREATE INDEX and CREATE TRIGGER statements go with the old table.
+    # Indexes made for constraints have no SQL, and are made again above.
+    schema = [row[0] for row in con.execute('SELECT sql FROM sqlite_master WHERE tbl_name = \'stop_times\' '
+        'AND type IN (\'index\', \'trigger\') AND sql IS NOT NULL ORDER BY type')]
+
+    con.execute('DROP TABLE IF EXISTS stop_times_prepare')
+    con.execute(f'CREATE TABLE stop_times_prepare ({", ".join(definitions)}){options}')
+    con.execute(f'INSERT INTO stop_times_prepare SELECT {", ".join(column_selects)} FROM stop_times')
+    con.execute('DROP TABLE stop_times')
+
+    # Views and other tables' triggers that use stop_times are left as they
+    # are, and find the new table by its name
+    con.execute('PRAGMA legacy_alter_table = ON')
+    try:
+        con.execute('ALTER TABLE stop_times_prepare RENAME TO stop_times')
+    finally:
+        con.execute('PRAGMA legacy_alter_table = OFF')
+
+    for sql in schema:
+        con.execute(sql)
+
+    return [clause for clause in UNKEPT_CLAUSES if re.search(rf'\b{clause}\b', table_sql, re.IGNORECASE)]
+
+def has_table(con, table):
+    return con.execute('SELECT COUNT(*) FROM sqlite_master WHERE type = \'table\' AND name = ?', [table]).fetchone()[0] > 0
+
+# The dates each calendar.txt service runs on from its weekday pattern
+def _calendar_dates(con):
+    for row in con.execute(f'SELECT service_id, start_date, end_date, {", ".join(WEEKDAYS)} FROM calendar'):
+        (service_id, start_date, end_date) = row[:3]
+        weekdays = [int(day) == 1 for day in row[3:]]
+
+        current_date = datetime.strptime(str(start_date), '%Y%m%d').date()
+        end_date = datetime.strptime(str(end_date), '%Y%m%d').date()
+        while current_date <= end_date:
+            if weekdays[current_date.weekday()]:
+                yield (current_date.strftime('%Y%m%d'), service_id)
+            current_date += timedelta(days=1)
+
+# Rebuild active_services, the (date, service_id) pairs that run: the
+# calendar.txt weekday patterns plus calendar_dates additions, less its removals
+def _build_active_services(con):
+    con.execute('DROP TABLE IF EXISTS active_services')
+    con.execute('CREATE TABLE active_services (date TEXT, service_id TEXT, PRIMARY KEY (date, service_id)) WITHOUT ROWID')
+
+    if has_table(con, 'calendar'):
+        con.executemany('INSERT OR IGNORE INTO active_services VALUES (?, ?)', _calendar_dates(con))
+
+    if has_table(con, 'calendar_dates'):
+        con.execute('INSERT OR IGNORE INTO active_services SELECT date, service_id FROM calendar_dates '
+            'WHERE CAST(exception_type AS INTEGER) = 1')
+        con.execute('DELETE FROM active_services WHERE (date, service_id) IN '
+            '(SELECT date, service_id FROM calendar_dates WHERE CAST(exception_type AS INTEGER) = 2)')
+
+    return con.execute('SELECT COUNT(*) FROM active_services').fetchone()[0]
+
+# Upgrade a GTFS database so the trips query runs from indexes:
+# integer stop sequences, the indexes in TRIP_INDEXES, the active_services
+# table and fresh statistics.
+def prepare_database(db_file):
+    con = sqlite3.connect(db_file)
+    try:
+        with con:
+            unkept = _integer_stop_sequence(con)
+            if unkept is not None:
+                print(f'{db_file}: converted stop_times.stop_sequence to INTEGER')
+                if len(unkept) > 0:
+                    print(f'{db_file}: WARNING: the {", ".join(unkept)} clauses of stop_times were not kept')
+
+            for (name, table, columns) in TRIP_INDEXES:
+                if has_table(con, table):
+                    con.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})')
+
+            print(f'{db_file}: {_build_active_services(con)} active services')
+
+            con.execute(f'PRAGMA user_version = {PREPARED_VERSION}')
+
+        con.execute('ANALYZE')
+    finally:
+        con.close()
+
+# Get the query plan for a database's trips query
+def explain_trips(db):
+    dates = [date.today().strftime('%Y%m%d')] * 3
+    con = sqlite3.connect(db['db_file'])
+    try:
+        trip_query = make_trip_query(len(db['departure_stops']), len(db['arrival_stops']), len(dates), get_version(con))
+        plan = con.execute(f'EXPLAIN QUERY PLAN {trip_query}', db['departure_stops'] + db['arrival_stops'] + dates).fetchall()
+    finally:
+        con.close()
+
+    return [detail for (_, _, _, detail) in plan]
+
+# Load the settings for a single GTFS database from its TOML file
+def load_gtfs_file(gtfs_file):
+    with open(gtfs_file) as gf:
+        gf_content = toml.load(gf)
+
+    db = {}
+    db['db_file'] = gf_content['gtfs']['database']
+    db['departure_stops'] = gf_content['gtfs']['departure_stops']
+    db['arrival_stops'] = gf_content['gtfs']['arrival_stops']
+    db['replacements'] = gf_content['gtfs']['replacements']
+    db['default_color'] = gf_content['gtfs']['default_color']
+    db['realtime'] = gf_content['gtfs'].get('realtime') or None
+    db['transfers'] = gf_content['gtfs'].get('transfers', 0)
+    db['transfer_time'] = gf_content['gtfs'].get('transfer_time', 120)
+    return db
+
 # Convert a date and time from the SQLite trips query to a timestamp
 def make_timestamp(date_str, time_str):
+    import pandas as pd
+
     timestamp = pd.to_datetime(date_str)
     hours = int(time_str[:2])
     if hours > 23:
@@ -20,31 +297,528 @@ def make_timestamp(date_str, time_str):
     timestamp += timedelta(hours=hours,minutes=int(time_str[3:5]), seconds=int(time_str[6:8]))
     return timestamp
 
-def day_old(timestamp):
-    return (datetime.now() - timestamp).total_seconds() > 86400
+# Convert the date and time columns from the SQLite trips query to timestamps
+# in one pass. Hours past 23 roll over into the next day as in make_timestamp.
+def make_timestamps(date_strs, time_strs):
+    import pandas as pd
+
+    if len(date_strs) == 0:
+        return pd.Series([], index=date_strs.index, dtype='datetime64[ns]')
+
+    times = time_strs.str.split(':', expand=True).astype(int)
+    offsets = pd.to_timedelta(times[0] * 3600 + times[1] * 60 + times[2], unit='s')
+    return pd.to_datetime(date_strs, format='%Y%m%d') + offsets
+
+# Apply a database's replacements in order, as DataFrame.replace does
+def replace_value(value, replacements):
+    for replacement in replacements:
+        if value == replacement[0]:
+            value = replacement[1]
+    return value
+
+def service_dates():
+    one_day = timedelta(days=1)
+    today = date.today().strftime('%Y%m%d')
+    yesterday = (date.today() - one_day).strftime('%Y%m%d')
+    tomorrow = (date.today() + one_day).strftime('%Y%m%d')
+    return [yesterday, today, tomorrow]
+
+# The engines return trip_rows without replacements, which are applied
+# to each database's string_table instead.
+
+# Extract the trips for the given dates using pandas.
+# pandas is only imported when this engine is used.
+def extract_pandas(db, dates):
+    import pandas as pd
+
+    con = connect_read_only(db['db_file'])
+    try:
+        trip_query = make_trip_query(len(db['departure_stops']), len(db['arrival_stops']), len(dates), get_version(con))
+        trips = pd.read_sql_query(trip_query, con, params=db['departure_stops'] + db['arrival_stops'] + dates)
+    finally:
+        con.close()
+
+    trips['timestamp'] = make_timestamps(trips['date'], trips['departure_time'])
+    trips['color'] = trips['color'].replace('', db['default_color'])
+    trips = trips.drop_duplicates()
+
+    return [trip_row(row[0].to_pydatetime(), *row[1:]) for row in trips[list(trip_row._fields)].itertuples(index=False, name=None)]
+
+# Extract the trips for the given dates using only sqlite3 and the stdlib
+def extract_sqlite(db, dates):
+    con = connect_read_only(db['db_file'])
+    try:
+        trip_query = make_trip_query(len(db['departure_stops']), len(db['arrival_stops']), len(dates), get_version(con))
+        rows = con.execute(trip_query, db['departure_stops'] + db['arrival_stops'] + dates).fetchall()
+    finally:
+        con.close()
+
+    # Dates repeat a lot, so each distinct one is only parsed once
+    day_starts = dict()
+
+    trips = []
+    for row in dict.fromkeys(rows):
+        (trip_id, stop_id, _, route, destination, color, date_str, departure_time, stop_sequence) = row
+
+        if date_str not in day_starts:
+            day_starts[date_str] = datetime.strptime(date_str, '%Y%m%d')
+        (hours, minutes, seconds) = departure_time.split(':')
+        timestamp = day_starts[date_str] + timedelta(hours=int(hours), minutes=int(minutes), seconds=int(seconds))
+
+        if color == '':
+            color = db['default_color']
+
+        trips.append(trip_row(timestamp, color, route, destination, trip_id, stop_id, stop_sequence, date_str))
+
+    return trips
+
+ENGINES = {
+    'pandas': extract_pandas,
+    'sqlite': extract_sqlite
+}
+
+# Read the TripUpdates from a GTFS-Realtime feed at a URL or local path,
+# keyed by trip_id. Needs the gtfs-realtime-bindings package.
+def read_trip_updates(source):
+    from google.transit import gtfs_realtime_pb2
+
+    if source.startswith('http'):
+        response = requests.get(source, timeout=REALTIME_TIMEOUT)
+        response.raise_for_status()
+        data = response.content
+    else:
+        with open(source, 'rb') as f:
+            data = f.read()
+
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(data)
+
+    canceled = gtfs_realtime_pb2.TripDescriptor.CANCELED
+    skipped = gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.SKIPPED
+
+    updates = dict()
+    for entity in feed.entity:
+        if not entity.HasField('trip_update'):
+            continue
+
+        update = entity.trip_update
+        stops = []
+        for stop_time in update.stop_time_update:
+            event = None
+            if stop_time.HasField('departure'):
+                event = stop_time.departure
+            elif stop_time.HasField('arrival'):
+                event = stop_time.arrival
+
+            stops.append(stop_update(
+                stop_time.stop_sequence if stop_time.HasField('stop_sequence') else None,
+                stop_time.stop_id if stop_time.HasField('stop_id') else None,
+                event.delay if event is not None and event.HasField('delay') else None,
+                event.time if event is not None and event.HasField('time') else None,
+                stop_time.schedule_relationship == skipped
+                ))
+
+        updates[update.trip.trip_id] = trip_update(
+            update.trip.start_date or None,
+            update.delay if update.HasField('delay') else None,
+            update.trip.schedule_relationship == canceled,
+            tuple(stops)
+            )
+
+    return updates
+
+# The stops of a trip as {stop_sequence: (stop_id, scheduled time)}, for
+# placing realtime stop updates along it
+def trip_stop_times(con, trip_id):
+    stop_times = dict()
+    for (stop_id, stop_sequence, arrival_time, departure_time) in con.execute(
+        'SELECT stop_id, stop_sequence, arrival_time, departure_time FROM stop_times WHERE trip_id = ?', [trip_id]):
+
+        stop_times[int(stop_sequence)] = (stop_id, departure_time or arrival_time)
+
+    return stop_times
+
+# The delay in seconds of a trip at a row's stop, or None if it won't call
+# there. A stop without its own update takes the last delay before it.
+# Stop updates given by stop_id, or with a time in place of a delay, are
+# placed using the trip's stop_times where they're known.
+def trip_delay(row, update, stop_times=None):
+    if update.cancelled:
+        return None
+
+    row_sequence = int(row.stop_sequence)
+
+    sequences = dict()
+    if stop_times is not None:
+        for (stop_sequence, (stop_id, _)) in sorted(stop_times.items()):
+            sequences.setdefault(stop_id, stop_sequence)
+
+    placed = []
+    for stop in update.stops:
+        stop_sequence = stop.stop_sequence
+        if stop_sequence is None:
+            stop_sequence = row_sequence if stop.stop_id == row.stop_id else sequences.get(stop.stop_id)
+        if stop_sequence is not None:
+            placed.append((stop_sequence, stop))
+    placed.sort(key=lambda item: item[0])
+
+    delay = update.delay
+    for (stop_sequence, stop) in placed:
+        if stop_sequence > row_sequence:
+            break
+
+        if stop_sequence == row_sequence and stop.skipped:
+            return None
+
+        stop_delay = stop.delay
+        if stop_delay is None and stop.time is not None:
+            if stop_sequence == row_sequence:
+                stop_delay = int(stop.time - row.timestamp.timestamp())
+            elif stop_times is not None and stop_sequence in stop_times and stop_times[stop_sequence][1]:
+                scheduled = datetime.strptime(row.date, '%Y%m%d') + timedelta(seconds=gtfs_seconds(stop_times[stop_sequence][1]))
+                stop_delay = int(stop.time - scheduled.timestamp())
+
+        if stop_delay is not None:
+            delay = stop_delay
+
+    return 0 if delay is None else delay
+
+# Interned strings for one database. Each distinct value is held once, and
+# its replacement from gtfs.toml is worked out once when it is first seen.
+class string_table:
+    def __init__(self, replacements):
+        self.replacements = replacements
+        self.codes = dict()
+        self.values = []
+        self.display = []
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+            self.display.append(replace_value(value, self.replacements))
+        return code
+
+# The trip_row fields held as string_table codes
+ENCODED_FIELDS = ['color', 'route', 'destination', 'trip_id', 'stop_id', 'date']
+
+# Trips held as columns: timestamps in epoch seconds, stop sequences and
+# string_table codes for the text fields
+class trip_columns:
+    def __init__(self):
+        self.timestamps = array('q')
+        self.stop_sequences = array('i')
+        self.codes = [array('i') for _ in ENCODED_FIELDS]
+
+    def __len__(self):
+        return len(self.timestamps)
+
+def encode_trips(rows, strings):
+    columns = trip_columns()
+    for row in rows:
+        columns.timestamps.append(int(row.timestamp.timestamp()))
+        columns.stop_sequences.append(int(row.stop_sequence))
+        for (field, codes) in zip(ENCODED_FIELDS, columns.codes):
+            codes.append(strings.code(getattr(row, field)))
+    return columns
+
+# The trips for all feeds sorted by timestamp, with realtime delays. Feeds
+# are numbered by their place in the configuration, with a string_table and
+# database file for each; two feeds can share a database.
+class trip_store:
+    def __init__(self, feed_columns, strings, db_files):
+        self.strings = strings
+        self.db_files = db_files
+
+        timestamps = array('q')
+        feeds = array('B')
+        stop_sequences = array('i')
+        codes = [array('i') for _ in ENCODED_FIELDS]
+        for (feed, columns) in feed_columns:
+            timestamps.extend(columns.timestamps)
+            feeds.extend([feed] * len(columns))
+            stop_sequences.extend(columns.stop_sequences)
+            for (field_codes, column_codes) in zip(codes, columns.codes):
+                field_codes.extend(column_codes)
+
+        order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+        self.timestamps = array('q', [timestamps[index] for index in order])
+        self.feeds = array('B', [feeds[index] for index in order])
+        self.stop_sequences = array('i', [stop_sequences[index] for index in order])
+        self.codes = [array('i', [field_codes[index] for index in order]) for field_codes in codes]
+
+        # Row indexes for each feed's trips, built when first needed
+        self.trip_index = None
+
+        # Delays in seconds by row index. None means the trip won't call.
+        self.delays = dict()
+        self.max_delay = 0
+        self.min_delay = 0
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    # The trip_columns for one feed's trips on the given service dates
+    def select(self, feed, dates):
+        columns = trip_columns()
+        strings = self.strings[feed]
+        date_codes = set(strings.codes[service_date] for service_date in dates if service_date in strings.codes)
+        service_dates = self.codes[ENCODED_FIELDS.index('date')]
+
+        for index in range(len(self.timestamps)):
+            if self.feeds[index] == feed and service_dates[index] in date_codes:
+                columns.timestamps.append(self.timestamps[index])
+                columns.stop_sequences.append(self.stop_sequences[index])
+                for (column_codes, field_codes) in zip(columns.codes, self.codes):
+                    column_codes.append(field_codes[index])
+
+        return columns
+
+    # The trip_row for an index, with replacements applied for display
+    def row(self, index):
+        strings = self.strings[self.feeds[index]]
+        (color, route, destination, trip_id, stop_id, service_date) = [field_codes[index] for field_codes in self.codes]
+        return trip_row(datetime.fromtimestamp(self.timestamps[index]), strings.display[color], strings.display[route],
+            strings.display[destination], strings.values[trip_id], strings.values[stop_id], self.stop_sequences[index],
+            strings.values[service_date])
+
+    def _build_trip_index(self):
+        self.trip_index = [dict() for _ in self.strings]
+        trip_ids = self.codes[ENCODED_FIELDS.index('trip_id')]
+        for index in range(len(self.timestamps)):
+            self.trip_index[self.feeds[index]].setdefault(trip_ids[index], []).append(index)
+
+    # Update the delays of the rows for the given trips. An update of None
+    # puts a trip back on schedule.
+    def apply_trip_updates(self, feed, updates):
+        if self.trip_index is None:
+            self._build_trip_index()
+
+        db_file = self.db_files[feed]
+        trip_rows = self.trip_index[feed]
+        strings = self.strings[feed]
+        now = datetime.now()
+
+        con = None
+        try:
+            for (trip_id, update) in updates.items():
+                rows = [(index, self.row(index)) for index in trip_rows.get(strings.codes.get(trip_id), [])]
+                if update is not None and update.start_date is None and len(rows) > 0:
+                    # Without a start date the update is for the nearest run of the trip
+                    nearest_date = min(rows, key=lambda item: abs((item[1].timestamp - now).total_seconds()))[1].date
+                else:
+                    nearest_date = None
+
+                # The trip's stops, to place its stop updates
+                stop_times = None
+                if update is not None and len(rows) > 0 and len(update.stops) > 0:
+                    try:
+                        if con is None:
+                            con = connect_read_only(db_file)
+                        stop_times = trip_stop_times(con, trip_id)
+                    except Exception as e:
+                        logging.error(f'Error reading stop times for trip {trip_id}')
+                        logging.error(e)
+
+                for (index, row) in rows:
+                    if update is None or row.date != (update.start_date or nearest_date):
+                        delay = 0
+                    else:
+                        delay = trip_delay(row, update, stop_times)
+
+                    if delay == 0:
+                        self.delays.pop(index, None)
+                    else:
+                        self.delays[index] = delay
+        finally:
+            if con is not None:
+                con.close()
+
+        # Trips can run early as well as late
+        delays = [delay for delay in self.delays.values() if delay is not None]
+        self.max_delay = max(delays + [0])
+        self.min_delay = min(delays + [0])
+
+# Seconds after midnight for a GTFS HH:MM:SS time
+def gtfs_seconds(time_str):
+    (hours, minutes, seconds) = time_str.split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+# Every hop between consecutive stops of every trip in a service window,
+# held in arrays sorted by departure time for connection scan searches.
+# Times are epoch seconds; stops and trips are integer codes.
+class connection_index:
+    def __init__(self, db, dates, strings):
+        con = connect_read_only(db['db_file'])
+        try:
+            rows = con.execute(make_connection_query(len(dates), get_version(con)), dates)
+
+            self.strings = strings
+            self.stop_codes = dict()
+            self.stop_names = array('i')
+            self.trip_info = []
+
+            day_starts = dict()
+
+            connections = []
+            last_trip = None
+            for (date_str, trip_id, stop_id, stop_name, arrival_time, departure_time, route, destination, color) in rows:
+                if arrival_time == '' and departure_time == '':
+                    continue
+
+                if stop_id not in self.stop_codes:
+                    self.stop_codes[stop_id] = len(self.stop_names)
+                    self.stop_names.append(strings.code(stop_name))
+                stop = self.stop_codes[stop_id]
+
+                if (date_str, trip_id) != last_trip:
+                    last_trip = (date_str, trip_id)
+                    self.trip_info.append((strings.code(color or db['default_color']), strings.code(route), strings.code(destination)))
+                    last_stop = None
+
+                if date_str not in day_starts:
+                    day_starts[date_str] = int(datetime.strptime(date_str, '%Y%m%d').timestamp())
+
+                arrival = day_starts[date_str] + gtfs_seconds(arrival_time or departure_time)
+                if last_stop is not None:
+                    connections.append((last_departure, arrival, last_stop, stop, len(self.trip_info) - 1))
+
+                last_stop = stop
+                last_departure = day_starts[date_str] + gtfs_seconds(departure_time or arrival_time)
+        finally:
+            con.close()
+
+        connections.sort()
+        self.departures = array('q', [connection[0] for connection in connections])
+        self.arrivals = array('q', [connection[1] for connection in connections])
+        self.departure_stops = array('i', [connection[2] for connection in connections])
+        self.arrival_stops = array('i', [connection[3] for connection in connections])
+        self.trips = array('i', [connection[4] for connection in connections])
+
+    def stops(self, stop_ids):
+        return set(self.stop_codes[stop_id] for stop_id in stop_ids if stop_id in self.stop_codes)
+
+    # Find the journey from sources to targets leaving at or after start that
+    # arrives earliest, using at most max_transfers changes of at least
+    # transfer_time seconds. Returns a list of (board, alight) connection
+    # indexes, one per leg, or None.
+    def earliest_arrival(self, sources, targets, start, max_transfers, transfer_time):
+        rounds = max_transfers + 1
+
+        # For each number of changes: the earliest arrival at each stop, the
+        # leg that got there, and the connection each trip was boarded at
+        arrival = [dict() for _ in range(rounds)]
+        legs = [dict() for _ in range(rounds)]
+        boarded = [dict() for _ in range(rounds)]
+
+        best_arrival = None
+        best = None
+
+        for index in range(bisect_left(self.departures, start), len(self.departures)):
+            departure = self.departures[index]
+            if best_arrival is not None and departure >= best_arrival:
+                break
+
+            trip = self.trips[index]
+            departure_stop = self.departure_stops[index]
+            arrival_stop = self.arrival_stops[index]
+            arrival_time = self.arrivals[index]
+
+            for change in range(rounds):
+                if trip not in boarded[change]:
+                    if change == 0:
+                        can_board = departure_stop in sources
+                    else:
+                        previous = arrival[change - 1].get(departure_stop)
+                        can_board = previous is not None and previous + transfer_time <= departure
+
+                    if not can_board:
+                        continue
+                    boarded[change][trip] = index
+
+                if arrival_time < arrival[change].get(arrival_stop, arrival_time + 1):
+                    arrival[change][arrival_stop] = arrival_time
+                    legs[change][arrival_stop] = (boarded[change][trip], index)
+
+                    if arrival_stop in targets and (best_arrival is None or arrival_time < best_arrival):
+                        best_arrival = arrival_time
+                        best = (change, arrival_stop)
+
+        if best is None:
+            return None
+
+        (change, stop) = best
+        journey = []
+        while change >= 0:
+            leg = legs[change][stop]
+            journey.insert(0, leg)
+            stop = self.departure_stops[leg[0]]
+            change -= 1
+
+        return journey
+
+    # The journeys with at least one change that are the fastest way to
+    # travel when leaving at their departure time, up to count of them
+    def connecting_journeys(self, sources, targets, start, count, max_transfers, transfer_time):
+        journeys = []
+        for _ in range(count * 5):
+            journey = self.earliest_arrival(sources, targets, start, max_transfers, transfer_time)
+            if journey is None:
+                break
+
+            if len(journey) > 1:
+                journeys.append(journey)
+                if len(journeys) >= count:
+                    break
+
+            start = self.departures[journey[0][0]] + 1
+
+        return journeys
+
+    # A trip_row for displaying a journey found by connecting_journeys
+    def journey_row(self, journey):
+        display = self.strings.display
+        (color, route, destination) = [display[code] for code in self.trip_info[self.trips[journey[0][0]]]]
+        for (board, _) in journey[1:]:
+            (_, next_route, next_destination) = self.trip_info[self.trips[board]]
+            destination += f' > {display[next_route]} {display[next_destination]}'
+
+        timestamp = datetime.fromtimestamp(self.departures[journey[0][0]])
+        return trip_row(timestamp, color, route, destination, None, None, None, None)
 
 class gtfs(Thread):
-    def __init__(self, gtfs_files):
+    def __init__(self, gtfs_files, engine='pandas'):
         
         self.databases = []
+        self.extract = ENGINES[engine]
 
         for gtfs_file in gtfs_files:
-            with open(gtfs_file) as gf:
-                gf_content = toml.load(gf)
+            self.databases.append(load_gtfs_file(gtfs_file))
 
-                db = {}
-                db['db_file'] = gf_content['gtfs']['database']
-                db['departure_stops'] = gf_content['gtfs']['departure_stops']
-                db['arrival_stops'] = gf_content['gtfs']['arrival_stops']
-                db['replacements'] = gf_content['gtfs']['replacements']
-                db['default_color'] = gf_content['gtfs']['default_color']
-
-                self.databases.append(db)
+        # A string_table for each feed, and the service dates held for it.
+        # Feeds are kept apart by their place in gtfs_files, since two can
+        # use one database with different stops and replacements.
+        self.strings = [string_table(db['replacements']) for db in self.databases]
+        self.feed_days = [set() for _ in self.databases]
 
+        # The trip_store for all feeds
         self.trips = None
         self.trips_time = None
+        self.window = None
+
+        # The latest GTFS-Realtime trip updates for each feed
+        self.trip_updates = dict()
+        self.realtime_time = None
 
-        self.journeys = []
+        # Connection indexes for feeds with transfers enabled, and the
+        # connecting journeys found from them sorted by departure.
+        # Feeds whose index failed to build are retried like missing days.
+        self.connections = dict()
+        self.connections_time = None
+        self.failed_connections = set()
+        self.connecting = []
 
         self.stop_flag = False
 
@@ -53,77 +827,255 @@ class gtfs(Thread):
         self.start()
 
     def run(self):
-        # Get the lists
         self._extract_trips()
 
         while not self.stop_flag:
-            if self.trips_time is not None and day_old(self.trips_time):
+            if self.window != service_dates():
+                self._extract_trips()
+            elif self._missing_days() and (datetime.now() - self.trips_time).total_seconds() >= RETRY_INTERVAL:
                 self._extract_trips()
 
-            self._make_journeys()
+            if len(self.failed_connections) > 0 and (datetime.now() - self.connections_time).total_seconds() >= RETRY_INTERVAL:
+                self._build_connections(self.window, self.failed_connections)
+
+            if self.realtime_time is None or (datetime.now() - self.realtime_time).total_seconds() >= REALTIME_INTERVAL:
+                self._poll_realtime()
+
+            self._find_connecting()
 
             sleep_time = 0
             while not self.stop_flag and sleep_time < 10:
                 time.sleep(1)
                 sleep_time += 1
 
+    def _missing_days(self):
+        for days in self.feed_days:
+            if any(service_date not in days for service_date in self.window):
+                return True
+
+        return False
+
+    def _extract_feed(self, feed, dates):
+        days = dict()
+        for service_date in dates:
+            days[service_date] = encode_trips(self.extract(self.databases[feed], [service_date]), self.strings[feed])
+        return days
+
+    # Build connection indexes for the window, for feeds with transfers, or
+    # only those in feeds. A feed that fails keeps its old index until a
+    # retry works.
+    def _build_connections(self, dates, feeds=None):
+        for (feed, db) in enumerate(self.databases):
+            if db['transfers'] > 0 and (feeds is None or feed in feeds):
+                try:
+                    self.connections[feed] = connection_index(db, dates, self.strings[feed])
+                    self.failed_connections.discard(feed)
+                except Exception as e:
+                    self.failed_connections.add(feed)
+                    logging.error(f'Error building connections from {db["db_file"]}')
+                    logging.error(e)
+
+        self.connections_time = datetime.now()
+
+    def _find_connecting(self):
+        start = int(time.time())
+
+        connecting = []
+        for (feed, db) in enumerate(self.databases):
+            index = self.connections.get(feed)
+            if index is not None:
+                journeys = index.connecting_journeys(index.stops(db['departure_stops']), index.stops(db['arrival_stops']),
+                    start, CONNECTING_JOURNEYS, db['transfers'], db['transfer_time'])
+                connecting.extend(index.journey_row(journey) for journey in journeys)
+
+        self.connecting = sorted(connecting, key=attrgetter('timestamp'))
+
+    # Roll the service day window forward. Only days that aren't already held
+    # are extracted, with the feeds in parallel, and days that have left the
+    # window are dropped. A feed that fails keeps the days it has.
     def _extract_trips(self):
-        one_day = timedelta(days=1)
-        today = date.today().strftime('%Y%m%d')
-        yesterday = (date.today() - one_day).strftime('%Y%m%d')
-        tomorrow = (date.today() + one_day).strftime('%Y%m%d')
-        dates = [yesterday, today, tomorrow]
-
-
-        collected_trips = []
-
-        for db in self.databases:
-            with sqlite3.connect(db['db_file']) as con:
-                trip_query = (
-                'SELECT st1.trip_id, st1.stop_id, s.stop_name, r.route_short_name AS route, t.trip_headsign AS destination, '
-                'r.route_color as color, c.date, st1.departure_time '
-                'FROM stop_times st1 INNER JOIN stop_times st2 ON st1.trip_id = st2.trip_id '
-                'INNER JOIN stops s ON s.stop_id = st1.stop_id '
-                'INNER JOIN trips t ON t.trip_id = st1.trip_id '
-                'INNER JOIN routes r ON t.route_id = r.route_id '
-                'INNER JOIN calendar_dates c ON c.service_id = t.service_id '
-                f'WHERE st1.stop_id IN ({make_in_params(len(db["departure_stops"]))}) AND st2.stop_id IN ({make_in_params(len(db["arrival_stops"]))}) '
-                'AND CAST(st2.stop_sequence AS INTEGER) > CAST(st1.stop_sequence AS INTEGER) '
-                'AND c.exception_type = 1 '
-                f'AND c.date IN ({make_in_params(len(dates))}) '
-                'ORDER BY c.date, st1.departure_time'
-                )
-
-            trips = pd.read_sql_query(trip_query, con, params=db['departure_stops'] + db['arrival_stops'] + dates)
-            trips['timestamp'] = trips.apply(lambda row: make_timestamp(row.date, row.departure_time), axis=1)
-            trips['color'] = trips['color'].replace('', db['default_color'])
-
-            for replacement in db['replacements']:
-                trips.replace(replacement[0], replacement[1], inplace=True)
-
-            trips = trips.drop_duplicates()
-
-            collected_trips.append(trips)
-
-        self.trips = pd.concat(collected_trips).sort_values(by='timestamp')
+        dates = service_dates()
+        feed_columns = []
+
+        with ThreadPoolExecutor(max_workers=len(self.databases)) as executor:
+            futures = []
+            for (feed, days) in enumerate(self.feed_days):
+                days.intersection_update(dates)
+                if self.trips is not None:
+                    feed_columns.append((feed, self.trips.select(feed, days)))
+
+                new_dates = [service_date for service_date in dates if service_date not in days]
+                if len(new_dates) > 0:
+                    futures.append((feed, executor.submit(self._extract_feed, feed, new_dates)))
+
+            for (feed, future) in futures:
+                try:
+                    for (service_date, columns) in future.result().items():
+                        feed_columns.append((feed, columns))
+                        self.feed_days[feed].add(service_date)
+                except Exception as e:
+                    logging.error(f'Error extracting trips from {self.databases[feed]["db_file"]}')
+                    logging.error(e)
+
+        store = trip_store(feed_columns, self.strings, [db['db_file'] for db in self.databases])
+        for (feed, updates) in self.trip_updates.items():
+            store.apply_trip_updates(feed, updates)
+
+        self.trips = store
         self.trips_time = datetime.now()
 
-    def format_row(self, row):
-        timediff = row.timestamp - datetime.now()
+        if self.window != dates:
+            self._build_connections(dates)
+
+        self.window = dates
+
+    # Read the realtime sources and pass the trips whose updates have
+    # changed since the last poll to the trip store
+    def _poll_realtime(self):
+        self.realtime_time = datetime.now()
+
+        for (feed, db) in enumerate(self.databases):
+            if db['realtime'] is None:
+                continue
+
+            try:
+                updates = read_trip_updates(db['realtime'])
+            except Exception as e:
+                logging.error(f'Error reading realtime updates from {db["realtime"]}')
+                logging.error(e)
+                continue
+
+            previous = self.trip_updates.get(feed, dict())
+            changed = {trip_id: update for (trip_id, update) in updates.items() if previous.get(trip_id) != update}
+            for trip_id in previous.keys():
+                if trip_id not in updates:
+                    changed[trip_id] = None
+
+            self.trip_updates[feed] = updates
+            if self.trips is not None and len(changed) > 0:
+                self.trips.apply_trip_updates(feed, changed)
+
+    def format_row(self, row, now, delay=0):
+        timestamp = row.timestamp + timedelta(seconds=delay)
+        timediff = timestamp - now
         minutes_diff = int(timediff.total_seconds() / 60)
         if minutes_diff > 59:
             hours = int(minutes_diff / 60)
             timediff_str = f'{hours}h{minutes_diff - (hours * 60):02d}m'
         else:
             timediff_str = f'{str(minutes_diff)}m'
-        return [row.color, minutes_diff, f'{row.timestamp.strftime("%H:%M")}', timediff_str.rjust(6), f'{row.route.rjust(2)} {row.destination}']
 
-    def _make_journeys(self):
-        journey_info = self.trips[self.trips['timestamp'] > datetime.now()]
-        self.journeys = journey_info.apply(lambda row: self.format_row(row), axis=1).drop_duplicates()
+        delay_str = ''
+        if delay >= 60:
+            delay_str = f' +{int(delay / 60)}m'
+
+        return [row.color, minutes_diff, f'{timestamp.strftime("%H:%M")}', timediff_str.rjust(6), f'{row.route.rjust(2)} {row.destination}{delay_str}']
+
+    # Format the next trips after now, in the order they're expected to
+    # leave. The start is found by binary search, allowing for the longest
+    # delay. Rows are in scheduled order, so the search stops once no later
+    # row could be expected before the limit-th journey found so far.
+    # Trips that won't call are skipped.
+    def get_journeys(self, limit=None):
+        store = self.trips
+        if store is None:
+            return []
+
+        now = datetime.now()
+        now_seconds = now.timestamp()
+        start = bisect_right(store.timestamps, now_seconds - store.max_delay)
+
+        # (expected time, row index, journey), sorted
+        candidates = []
+        seen = set()
+        for index in range(start, len(store)):
+            if limit is not None and len(candidates) >= limit and store.timestamps[index] + store.min_delay > candidates[limit - 1][0]:
+                break
 
-    def get_journeys(self):
-        return self.journeys
+            delay = store.delays.get(index, 0)
+            if delay is None:
+                continue
+
+            expected = store.timestamps[index] + delay
+            if expected <= now_seconds:
+                continue
+
+            journey = self.format_row(store.row(index), now, delay)
+            key = tuple(journey)
+            if key not in seen:
+                seen.add(key)
+                insort(candidates, (expected, index, journey))
+
+        journeys = [journey for (_, _, journey) in candidates[:limit]]
+
+        # Mix in the connecting journeys by departure time
+        connecting = [self.format_row(row, now) for row in self.connecting if row.timestamp > now]
+        if len(connecting) > 0:
+            journeys = sorted(journeys + connecting, key=lambda journey: journey[1])
+            if limit is not None:
+                journeys = journeys[:limit]
+
+        return journeys
 
     def stop(self):
         self.stop_flag = True
+
+
+# Run from parent directory, i.e. python gtfs/gtfs.py prepare gtfs.toml
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(prog='GTFS')
+    subparsers = arg_parser.add_subparsers(dest='command', required=True)
+    prepare_parser = subparsers.add_parser('prepare', help='Add indexes and statistics to GTFS databases')
+    prepare_parser.add_argument('files', nargs='+', help='GTFS TOML files')
+
+    benchmark_parser = subparsers.add_parser('benchmark', help='Compare the extraction engines')
+    benchmark_parser.add_argument('--engine', choices=ENGINES.keys(), help='Measure a single engine in this process')
+    benchmark_parser.add_argument('--repeat', type=int, default=5, help='Number of extractions to time')
+    benchmark_parser.add_argument('files', nargs='+', help='GTFS TOML files')
+
+    args = arg_parser.parse_args()
+
+    if args.command == 'prepare':
+        for gtfs_file in args.files:
+            db = load_gtfs_file(gtfs_file)
+            prepare_database(db['db_file'])
+
+            print(f'Query plan for {db["db_file"]}:')
+            plan = explain_trips(db)
+            for detail in plan:
+                print(f'  {detail}')
+
+            if any(detail.startswith('SCAN st') for detail in plan):
+                print('  WARNING: stop_times is still scanned in full')
+
+    elif args.command == 'benchmark' and args.engine is not None:
+        start = time.perf_counter()
+        if args.engine == 'pandas':
+            import pandas
+        import_time = time.perf_counter() - start
+
+        databases = [load_gtfs_file(gtfs_file) for gtfs_file in args.files]
+        dates = service_dates()
+
+        extract_times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            trip_count = sum(len(ENGINES[args.engine](db, dates)) for db in databases)
+            extract_times.append(time.perf_counter() - start)
+
+        print(json.dumps({
+            'import': import_time,
+            'extract': min(extract_times),
+            'trips': trip_count,
+            'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            }))
+
+    elif args.command == 'benchmark':
+        # Each engine runs in its own process so imports and memory don't mix
+        print(f'{"engine":8} {"import":>9} {"extract":>9} {"trips":>7} {"max RSS":>10}')
+        for engine in ENGINES.keys():
+            output = subprocess.run([sys.executable, __file__, 'benchmark', '--engine', engine,
+                '--repeat', str(args.repeat)] + args.files, capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.splitlines()[-1])
+            print(f'{engine:8} {result["import"] * 1000:7.1f}ms {result["extract"] * 1000:7.1f}ms '
+                f'{result["trips"]:7d} {result["rss"] / 1024:8.1f}MB')
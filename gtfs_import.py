@@ -0,0 +1,150 @@
+import argparse
+import csv
+import io
+from itertools import islice
+import os
+import sqlite3
+import zipfile
+from gtfs import gtfs
+
+# Rows per INSERT transaction
+BATCH_SIZE = 10000
+
+# The tables built from the feed, as file name -> [(column, type)]
+TABLES = {
+    'stops': [('stop_id', 'TEXT'), ('stop_name', 'TEXT')],
+    'routes': [('route_id', 'TEXT'), ('route_short_name', 'TEXT'), ('route_color', 'TEXT')],
+    'trips': [('trip_id', 'TEXT'), ('route_id', 'TEXT'), ('service_id', 'TEXT'), ('trip_headsign', 'TEXT')],
+    'stop_times': [('trip_id', 'TEXT'), ('arrival_time', 'TEXT'), ('departure_time', 'TEXT'),
+        ('stop_id', 'TEXT'), ('stop_sequence', 'INTEGER')],
+    'calendar': [('service_id', 'TEXT'), ('monday', 'INTEGER'), ('tuesday', 'INTEGER'),
+        ('wednesday', 'INTEGER'), ('thursday', 'INTEGER'), ('friday', 'INTEGER'),
+        ('saturday', 'INTEGER'), ('sunday', 'INTEGER'), ('start_date', 'TEXT'), ('end_date', 'TEXT')],
+    'calendar_dates': [('service_id', 'TEXT'), ('date', 'TEXT'), ('exception_type', 'INTEGER')]
+}
+
+# Stream the rows of a feed file as tuples in TABLES column order.
+# Columns missing from the file are filled with ''.
+def read_rows(feed, table):
+    with feed.open(f'{table}.txt') as raw:
+        reader = csv.reader(io.TextIOWrapper(raw, encoding='utf-8-sig', newline=''))
+        header = [column.strip() for column in next(reader)]
+        indexes = [header.index(column) if column in header else None for (column, _) in TABLES[table]]
+
+        for row in reader:
+            if len(row) == 0:
+                continue
+            yield tuple('' if index is None or index >= len(row) else row[index].strip() for index in indexes)
+
+# Find the trips that call at a departure stop before an arrival stop
+def find_trips(feed, departure_stops, arrival_stops):
+    departure_stops = set(departure_stops)
+    arrival_stops = set(arrival_stops)
+    first_departure = dict()
+    last_arrival = dict()
+
+    for (trip_id, _, _, stop_id, stop_sequence) in read_rows(feed, 'stop_times'):
+        if stop_id in departure_stops:
+            sequence = int(stop_sequence)
+            if trip_id not in first_departure or sequence < first_departure[trip_id]:
+                first_departure[trip_id] = sequence
+        if stop_id in arrival_stops:
+            sequence = int(stop_sequence)
+            if trip_id not in last_arrival or sequence > last_arrival[trip_id]:
+                last_arrival[trip_id] = sequence
+
+    return set(trip_id for (trip_id, sequence) in first_departure.items()
+        if trip_id in last_arrival and last_arrival[trip_id] > sequence)
+
+# Pass through the rows of kept trips, recording the values in
+# the given columns as they go by
+def filter_trips(rows, trip_ids, collect):
+    for row in rows:
+        if row[0] in trip_ids:
+            for (index, values) in collect:
+                values.add(row[index])
+            yield row
+
+def insert_rows(con, table, rows):
+    columns = TABLES[table]
+    insert = f'INSERT INTO {table} VALUES ({gtfs.make_in_params(len(columns))})'
+
+    count = 0
+    while True:
+        batch = list(islice(rows, BATCH_SIZE))
+        if len(batch) == 0:
+            break
+
+        with con:
+            con.executemany(insert, batch)
+        count += len(batch)
+
+    print(f'{table}: {count} rows')
+
+# Build a GTFS database from a feed zip. If trip_ids is given only
+# those trips, and the stops, routes and services they use, are kept.
+def import_feed(zip_file, db_file, trip_ids=None):
+    with zipfile.ZipFile(zip_file) as feed:
+        feed_files = feed.namelist()
+
+        con = sqlite3.connect(db_file)
+        try:
+            for (table, columns) in TABLES.items():
+                con.execute(f'DROP TABLE IF EXISTS {table}')
+                con.execute(f'CREATE TABLE {table} ({", ".join(f"{name} {column_type}" for (name, column_type) in columns)})')
+
+            route_ids = set()
+            service_ids = set()
+            stop_ids = set()
+
+            trips = read_rows(feed, 'trips')
+            if trip_ids is not None:
+                trips = filter_trips(trips, trip_ids, [(1, route_ids), (2, service_ids)])
+            insert_rows(con, 'trips', trips)
+
+            stop_times = read_rows(feed, 'stop_times')
+            if trip_ids is not None:
+                stop_times = filter_trips(stop_times, trip_ids, [(3, stop_ids)])
+            insert_rows(con, 'stop_times', stop_times)
+
+            for (table, keep) in [('stops', stop_ids), ('routes', route_ids),
+                ('calendar', service_ids), ('calendar_dates', service_ids)]:
+
+                if f'{table}.txt' not in feed_files:
+                    print(f'{table}: not in feed')
+                    continue
+
+                rows = read_rows(feed, table)
+                if trip_ids is not None:
+                    rows = (row for row in rows if row[0] in keep)
+                insert_rows(con, table, rows)
+        finally:
+            con.close()
+
+    gtfs.prepare_database(db_file)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(prog='GTFS Importer')
+    arg_parser.add_argument('feed', help='GTFS zip file')
+    arg_parser.add_argument('config', help='GTFS TOML file naming the database to build')
+    arg_parser.add_argument('--filter', action='store_true',
+        help='Only keep trips between the configured departure and arrival stops')
+
+    args = arg_parser.parse_args()
+    db = gtfs.load_gtfs_file(args.config)
+
+    trip_ids = None
+    with zipfile.ZipFile(args.feed) as feed:
+        if args.filter:
+            trip_ids = find_trips(feed, db['departure_stops'], db['arrival_stops'])
+            print(f'Keeping {len(trip_ids)} trips')
+
+    # Build alongside the old database and swap it in when complete
+    temp_file = f'{db["db_file"]}.import'
+    if os.path.exists(temp_file):
+        os.remove(temp_file)
+
+    import_feed(args.feed, temp_file, trip_ids)
+    os.replace(temp_file, db['db_file'])
+    print(f'Wrote {db["db_file"]}')
@@ -1,65 +1,236 @@
 import toml
 from hashlib import md5
-import copy
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from collections import namedtuple
 import json
 from dateutil import parser
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from email.utils import parsedate_to_datetime
 import time
-from threading import Thread
+from threading import Thread, Lock
 import pytz
 from tzlocal import get_localzone
 import logging
+import os
 
 RTM_URL = 'https://api.rememberthemilk.com/services/rest/?'
+
+# RTM allows an average of one request a second, with short bursts.
+# When it throttles us, wait as long as it says, or RATE_LIMIT_BACKOFF
+# seconds if it doesn't, up to THROTTLE_RETRIES times.
 RATE_LIMIT = 1
+RATE_BURST = 3
 RATE_LIMIT_BACKOFF = 1
+THROTTLE_RETRIES = 3
+THROTTLE_STATUS = (429, 503)
+REQUEST_TIMEOUT = 30
+
+# The lists and tasks from the last good sync, shown at startup
+CACHE_FILE = '.cache/rtm.json'
+
+# Tasks are shown if they're due before this many days from today
+DUE_DAYS = 3
+
+# After a full fetch only changes since the last sync are fetched, going
+# back SYNC_OVERLAP seconds further in case our clock is ahead of RTM's.
+# A full fetch is done again every FULL_SYNC_INTERVAL seconds in case
+# anything was missed.
+SYNC_OVERLAP = 60
+FULL_SYNC_INTERVAL = 86400
 ALL_TASKS = '_all'
 OVERDUE = -1
 TODAY = 0
 FUTURE = 1
 
+# A task with its local due date. Fields are in sort order.
+task = namedtuple('task', ['due', 'name'])
+
+# The tasks of one view as of one day, split into overdue, due today and
+# due in the future, each sorted by due date and name. Snapshots are
+# never changed once published; the worker replaces them.
+task_snapshot = namedtuple('task_snapshot', ['day', 'overdue', 'today', 'future', 'overdue_oldest'])
+
+EMPTY_SNAPSHOT = task_snapshot(None, (), (), (), 0)
+
 def midnight(date_object):
     return date_object.replace(hour=0, minute=0, second=0, microsecond=0)
 
+def local_today():
+    return midnight(datetime.now(get_localzone())).date()
+
+# RTM's JSON has a single item in place of a one item list, and leaves
+# out empty lists
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+# Token bucket rate limiter. Tokens build up at rate per second to at
+# most burst, and each request takes one. Being throttled empties the
+# bucket until the server's wait is over.
+class token_bucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    # Wait for a token and take it
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + max(0, now - self.updated) * self.rate)
+                self.updated = max(now, self.updated)
+
+                if now >= self.updated and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = max(self.updated - now, (1 - self.tokens) / self.rate)
+
+            time.sleep(wait)
+
+    # Hand out nothing for the next few seconds, then just one token
+    def block(self, seconds):
+        with self.lock:
+            self.tokens = 1
+            self.updated = max(self.updated, time.monotonic() + seconds)
+
+# The limit is per API key, so every rtm instance shares one bucket
+limiter = token_bucket(RATE_LIMIT, RATE_BURST)
+
+# How long a throttling response asks us to wait, in seconds
+def _retry_after(response):
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return RATE_LIMIT_BACKOFF
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now(pytz.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return RATE_LIMIT_BACKOFF
+
+# Apply a rtm.tasks.getList response to a task store. For incremental
+# responses a task may have moved from another list.
+def _merge_tasks(store, response, incremental):
+    for task_list in _as_list(response['rsp']['tasks'].get('list')):
+        list_id = task_list['id']
+
+        for series in _as_list(task_list.get('taskseries')):
+            for task_entry in _as_list(series.get('task')):
+                key = (list_id, series['id'], task_entry['id'])
+
+                if incremental and key not in store:
+                    for moved in [old_key for old_key in store.keys() if old_key[1:] == key[1:]]:
+                        del store[moved]
+
+                if task_entry.get('completed') or task_entry.get('deleted') or not task_entry.get('due'):
+                    store.pop(key, None)
+                else:
+                    entry_date = parser.parse(task_entry['due'])
+                    store[key] = task(midnight(entry_date.astimezone(get_localzone())).date(), series['name'])
+
+        for deleted in _as_list(task_list.get('deleted')):
+            for series in _as_list(deleted.get('taskseries')):
+                for task_entry in _as_list(series.get('task')):
+                    store.pop((list_id, series['id'], task_entry['id']), None)
+
+def _make_snapshot(day, tasks):
+    tasks.sort()
+    overdue = tuple(entry for entry in tasks if entry.due < day)
+    today = tuple(entry for entry in tasks if entry.due == day)
+    future = tuple(entry for entry in tasks if entry.due > day)
+    overdue_oldest = 0 if len(overdue) == 0 else (day - overdue[0].due).days
+
+    return task_snapshot(day, overdue, today, future, overdue_oldest)
+
+# Make snapshots of the tasks in a store that are due soon enough to show,
+# for ALL_TASKS and each of the given list IDs
+def _make_snapshots(store, list_ids):
+    day = local_today()
+    last_day = day + timedelta(days=DUE_DAYS)
+
+    views = {view: list() for view in [ALL_TASKS] + list_ids}
+    for ((list_id, _, _), entry) in store.items():
+        if entry.due >= last_day:
+            continue
+
+        views[ALL_TASKS].append(entry)
+        if list_id in views:
+            views[list_id].append(entry)
+
+    return {view: _make_snapshot(day, tasks) for (view, tasks) in views.items()}
+
 class rtm(Thread):
     def __init__(self, config):
         self.key = config['api_key']
         self.secret = config['shared_secret']
         self.token = config['token']
-        self.tasks = dict()
-        self.last_request = None
+        self.url = config.get('url', RTM_URL)
+        self.snapshots = dict()
         self.lists = dict()
+
+        # When tasks were last synced and fully fetched, and the incomplete
+        # tasks with due dates keyed by (list ID, taskseries ID, task ID)
+        self.last_sync = None
+        self.full_sync = None
+        self.store = dict()
         self.required_lists = config['required_lists']
         self.stop_flag = False
 
+        # Show the last good tasks straight away. They're stale until the
+        # first sync completes.
+        self.cache_file = config.get('cache_file', CACHE_FILE)
+        self.stale = True
+        self._load_cache()
+
+        # One session for every request, so the connection is kept alive
+        self.session = requests.Session()
+        retry = Retry(connect=5, backoff_factor=0.5)
+        adapter = HTTPAdapter(max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
         # Kick off the background retrieval thread
         Thread.__init__(self)
         self.start()
 
     def run(self):
-        # Get the lists
-        self._get_lists()
+        lists_fetched = False
 
         while not self.stop_flag:
-            self._fetch_tasks(None)
-            for rlist in self.required_lists:
-                if self.stop_flag:
-                    break
-                self._fetch_tasks(rlist)
+            # Get the lists, trying again each time until we have them.
+            # Until then any cached lists are used.
+            if not lists_fetched:
+                try:
+                    self._get_lists()
+                    lists_fetched = True
+                except Exception as e:
+                    logging.error(e)
+
+            self._fetch_tasks()
 
             sleep_time = 0
             while not self.stop_flag and sleep_time < 60:
                 time.sleep(1)
                 sleep_time += 1
 
-    def _request(self, method, params):
-        if self.last_request is not None and (datetime.now() - self.last_request).seconds < RATE_LIMIT:
-            time.sleep(RATE_LIMIT_BACKOFF)
+                # Move tasks along at midnight without waiting for a sync
+                snapshot = self.snapshots.get(ALL_TASKS)
+                if snapshot is not None and snapshot.day != local_today():
+                    self.snapshots = _make_snapshots(self.store, self._required_list_ids())
 
-        request_params = copy.deepcopy(params)
+    def _request(self, method, params):
+        request_params = dict(params)
         request_params['method'] = method
         request_params['api_key'] = self.key
         request_params['auth_token'] = self.token
@@ -67,31 +238,32 @@ class rtm(Thread):
 
         request_params = dict(sorted(request_params.items()))
 
-        request_string = RTM_URL
+        request_string = self.url
         sig = self.secret
         for (key, value) in request_params.items():
             request_string += f'{key}={value}&'
             sig += f'{key}{value}'
 
         request_string += f'api_sig={md5(sig.encode("utf-8")).hexdigest()}'
-        
-        session = requests.Session()
-        retry = Retry(connect=5, backoff_factor=0.5)
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
 
-        response = session.get(request_string)
+        for attempt in range(THROTTLE_RETRIES + 1):
+            limiter.acquire()
+            response = self.session.get(request_string, timeout=REQUEST_TIMEOUT)
+            if response.status_code not in THROTTLE_STATUS:
+                break
 
-        self.last_request = datetime.now()
+            limiter.block(_retry_after(response))
+
+        response.raise_for_status()
         return response.json()
 
     def _get_lists(self):
         lists_json = self._request('rtm.lists.getList', dict())
-        
-        self.lists = dict()
+
+        lists = dict()
         for list_entry in lists_json['rsp']['lists']['list']:
-            self.lists[list_entry['name']] = list_entry['id']
+            lists[list_entry['name']] = list_entry['id']
+        self.lists = lists
 
     def _get_list_id(self, list_name):
         if list_name == ALL_TASKS:
@@ -99,58 +271,99 @@ class rtm(Thread):
         else: 
             return None if list_name not in self.lists.keys() else self.lists[list_name]
 
-    def _fetch_tasks(self, list_name):
+    # Fetch the tasks in every list in one request, and split them into
+    # the all tasks view and one for each required list
+    def _fetch_tasks(self):
         try:
-            if list_name is None:
-                list_id = None
-            else:
-                list_id = self._get_list_id(list_name)
+            full = self.full_sync is None or time.time() - self.full_sync > FULL_SYNC_INTERVAL
 
             params = dict()
-            params['filter'] = 'status:incomplete AND dueBefore:"3 days of today"'
-
-            if list_id is not None:
-                params['list_id'] = list_id
+            if full:
+                # Due dates are filtered locally, since tasks come into range
+                # as the days pass without being changed
+                params['filter'] = 'status:incomplete'
+            else:
+                # No filter, so we hear about tasks being completed
+                params['last_sync'] = self.last_sync
 
+            sync_time = datetime.now(pytz.utc) - timedelta(seconds=SYNC_OVERLAP)
             raw_tasks = self._request('rtm.tasks.getList', params)
 
-            today = midnight(datetime.now(get_localzone())).date()
-            store_tasks = list()
-
-            task_series = raw_tasks['rsp']['tasks']['list']
-
-            for series in task_series:
-                for task in series['taskseries']:
-                    task_name = task['name']
-
-                    for task_entry in task['task']:
-                        entry_date = parser.parse(task_entry['due'])
-                        local_date = midnight(entry_date.astimezone(get_localzone())).date()
+            # Merge into a copy, so the store (perhaps loaded from the cache)
+            # is only replaced once the sync has worked
+            store = dict() if full else dict(self.store)
+            _merge_tasks(store, raw_tasks, not full)
+            self.store = store
+            self.last_sync = sync_time.strftime('%Y-%m-%dT%H:%M:%SZ')
+            if full:
+                self.full_sync = time.time()
+
+            self.snapshots = _make_snapshots(self.store, self._required_list_ids())
+            self.stale = False
+            self._save_cache()
+        except Exception as e:
+            # Start again from a full fetch
+            self.full_sync = None
+            logging.error(e)
 
-                        if local_date < today:
-                            status = OVERDUE
-                        elif local_date == today:
-                            status = TODAY
-                        else:
-                            status = FUTURE
+    def _required_list_ids(self):
+        list_ids = [self._get_list_id(list_name) for list_name in self.required_lists]
+        return [list_id for list_id in list_ids if list_id is not None]
 
-                        task_item = dict()
-                        task_item['name'] = task_name
-                        task_item['due'] = local_date.strftime("%Y-%m-%d")
-                        task_item['status'] = status
+    def _load_cache(self):
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+
+            store = dict()
+            for (list_id, series_id, task_id, name, due) in cache['tasks']:
+                store[(list_id, series_id, task_id)] = task(date.fromisoformat(due), name)
+
+            # Replaced by the first full fetch
+            self.store = store
+            self.lists = cache['lists']
+            self.snapshots = _make_snapshots(store, self._required_list_ids())
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.error('Error reading cached tasks')
+            logging.error(e)
 
-                        store_tasks.append(task_item)
+    # Write the lists and tasks to the cache file, replacing it in one go
+    def _save_cache(self):
+        cache = {
+            'lists': self.lists,
+            'tasks': [[list_id, series_id, task_id, entry.name, entry.due.isoformat()]
+                for ((list_id, series_id, task_id), entry) in self.store.items()]
+        }
 
-            if list_id is None:
-                self.tasks[ALL_TASKS] = store_tasks
-            else:
-                self.tasks[list_id] = store_tasks
+        try:
+            os.makedirs(os.path.dirname(self.cache_file) or '.', exist_ok=True)
+            with open(f'{self.cache_file}.tmp', 'w') as f:
+                json.dump(cache, f)
+            os.replace(f'{self.cache_file}.tmp', self.cache_file)
         except Exception as e:
+            logging.error('Error caching tasks')
             logging.error(e)
 
-    def get_tasks(self, list_name):
+    # The task_snapshot for a list, or all tasks if list_name is None
+    def get_snapshot(self, list_name=None):
         list_id = ALL_TASKS if list_name is None else self._get_list_id(list_name)
-        return list() if not list_id in self.tasks.keys() else self.tasks[list_id]
+        return self.snapshots.get(list_id, EMPTY_SNAPSHOT)
+
+    def get_tasks(self, list_name):
+        snapshot = self.get_snapshot(list_name)
+
+        tasks = list()
+        for (status, entries) in [(OVERDUE, snapshot.overdue), (TODAY, snapshot.today), (FUTURE, snapshot.future)]:
+            for entry in entries:
+                tasks.append({'name': entry.name, 'due': entry.due.strftime("%Y-%m-%d"), 'status': status})
+
+        return tasks
+
+    # Whether the tasks are from the cache, and not yet synced
+    def is_stale(self):
+        return self.stale
 
     def get_required_lists(self):
         return self.required_lists
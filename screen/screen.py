@@ -0,0 +1,173 @@
+from blessed import Terminal
+import argparse
+import io
+import random
+import sys
+import time
+
+# Each frame is drawn into a buffer of (character, style) cells, where the
+# style is the escape sequence that goes before the character. Only the
+# cells that differ from the last frame are sent to the terminal, in one
+# write. A double width character takes two cells, the second holding
+# CONTINUATION, which sends nothing since the terminal has already moved
+# past it.
+CONTINUATION = ''
+
+class screen:
+    def __init__(self, term, stream=sys.stdout):
+        self.term = term
+        self.stream = stream
+
+        # Totals over all frames, for measuring
+        self.frames = 0
+        self.bytes_written = 0
+        self.frame_time = 0
+
+        self.resize()
+
+    # Start again at the given size, or the terminal's current size.
+    # The next frame is sent in full.
+    def resize(self, width=None, height=None):
+        self.width = self.term.width if width is None else width
+        self.height = self.term.height if height is None else height
+        self.front = None
+        self.back = self._blank()
+
+    def _blank(self):
+        return [[(' ', '')] * self.width for _ in range(self.height)]
+
+    # Blank out whatever is left of a double width character that a write
+    # to cell x only partly covers
+    def _split_wide(self, row, x):
+        if x < self.width and row[x][0] == CONTINUATION:
+            row[x - 1] = (' ', row[x - 1][1])
+        if x + 1 < self.width and row[x + 1][0] == CONTINUATION:
+            row[x + 1] = (' ', row[x + 1][1])
+
+    # Draw text at a position, clipped to the screen. Characters are
+    # measured in terminal columns, so double width characters take two
+    # cells and zero width ones join the character before them.
+    def write(self, x, y, text, style=''):
+        if y < 0 or y >= self.height:
+            return
+
+        row = self.back[y]
+        for char in text:
+            if x >= self.width:
+                break
+
+            width = 1 if char.isascii() else self.term.length(char)
+            if width == 0:
+                last = x - 2 if x > 1 and row[x - 1][0] == CONTINUATION else x - 1
+                if last >= 0:
+                    row[last] = (row[last][0] + char, row[last][1])
+                continue
+
+            if x >= 0:
+                self._split_wide(row, x)
+                if width == 1:
+                    row[x] = (char, style)
+                elif x + 1 < self.width:
+                    self._split_wide(row, x + 1)
+                    row[x] = (char, style)
+                    row[x + 1] = (CONTINUATION, style)
+                else:
+                    # Half a character won't fit at the edge
+                    row[x] = (' ', style)
+            elif x + width > 0:
+                # Clipped at the left edge
+                self._split_wide(row, 0)
+                row[0] = (' ', style)
+            x += width
+
+    # Send the changes since the last frame, and start a new one.
+    # With full set every cell is sent. Returns the bytes written.
+    def flush(self, full=False):
+        start = time.perf_counter()
+
+        out = []
+        for y in range(self.height):
+            row = self.back[y]
+            old = None if full or self.front is None else self.front[y]
+            if row == old:
+                continue
+
+            x = 0
+            while x < self.width:
+                if old is not None and row[x] == old[x]:
+                    x += 1
+                    continue
+
+                # A run of changed cells, from the start of any double
+                # width character it begins inside
+                if row[x][0] == CONTINUATION and x > 0:
+                    x -= 1
+                out.append(self.term.move_xy(x, y))
+                style = None
+                while True:
+                    (char, cell_style) = row[x]
+                    if cell_style != style:
+                        out.append(self.term.normal + cell_style)
+                        style = cell_style
+                    out.append(char)
+                    x += 1
+
+                    if x >= self.width or (old is not None and row[x] == old[x] and row[x][0] != CONTINUATION):
+                        break
+
+        if len(out) > 0:
+            out.append(self.term.normal)
+
+        text = ''.join(out)
+        self.stream.write(text)
+        self.stream.flush()
+
+        self.front = self.back
+        self.back = self._blank()
+
+        byte_count = len(text.encode('utf-8'))
+        self.frames += 1
+        self.bytes_written += byte_count
+        self.frame_time += time.perf_counter() - start
+        return byte_count
+
+    def stats(self):
+        frames = max(1, self.frames)
+        return f'{self.frames} frames, {self.bytes_written / frames:.0f} bytes and {self.frame_time / frames * 1000:.2f}ms per frame'
+
+
+# Draw a dashboard-like screen of text, changing a few cells per frame,
+# and compare sending every frame in full with sending only the changes
+def benchmark(width, height, frames):
+    term = Terminal(kind='xterm-256color', force_styling=True)
+    styles = ['', str(term.bold + term.on_firebrick3), str(term.deepskyblue3), str(term.limegreen)]
+
+    random.seed(1)
+    lines = [''.join(random.choice('abcdefghij klmnop') for _ in range(width)) for _ in range(height)]
+    line_styles = [random.choice(styles) for _ in range(height)]
+
+    for full in (True, False):
+        stream = io.StringIO()
+        display = screen(term, stream)
+        display.resize(width, height)
+
+        for frame in range(frames):
+            for y in range(height):
+                display.write(0, y, lines[y], line_styles[y])
+
+            # A countdown and a clock, as the dashboard's changing parts
+            display.write(2, height // 2, f'{frame % 60:02d} min', styles[1])
+            display.write(width - 8, 0, f'{frame:08d}', styles[2])
+            display.flush(full)
+
+        print(f'{"full" if full else "changes":8} {display.stats()}')
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(prog='Screen')
+    arg_parser.add_argument('--width', type=int, default=160, help='Screen width')
+    arg_parser.add_argument('--height', type=int, default=48, help='Screen height')
+    arg_parser.add_argument('--frames', type=int, default=100, help='Number of frames to draw')
+
+    args = arg_parser.parse_args()
+    benchmark(args.width, args.height, args.frames)
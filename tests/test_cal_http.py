@@ -0,0 +1,129 @@
+from concurrent.futures import Future
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+
+import pytest
+
+from cal import cal
+
+def make_calendar(summary):
+    start = date.today() + timedelta(days=1)
+    return '\r\n'.join(['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//today//tests//EN',
+        'BEGIN:VEVENT', f'UID:{summary}@tests', f'SUMMARY:{summary}',
+        f'DTSTART;VALUE=DATE:{start.strftime("%Y%m%d")}',
+        f'DTEND;VALUE=DATE:{(start + cal.ONE_DAY).strftime("%Y%m%d")}', 'END:VEVENT', 'END:VCALENDAR']) + '\r\n'
+
+# Serves one calendar with an ETag, answering 304 when the client
+# already has it. Records the If-None-Match header of each request.
+class calendar_server:
+    def __init__(self):
+        self.body = make_calendar('First')
+        self.etag = '"v1"'
+        self.requests = []
+
+@pytest.fixture
+def server():
+    state = calendar_server()
+
+    class handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            state.requests.append(self.headers.get('If-None-Match'))
+            if self.headers.get('If-None-Match') == state.etag:
+                self.send_response(304)
+                self.send_header('ETag', state.etag)
+                self.end_headers()
+                return
+
+            body = state.body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/calendar; charset=utf-8')
+            self.send_header('ETag', state.etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    http_server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    state.url = f'http://127.0.0.1:{http_server.server_address[1]}/calendar.ics'
+    yield state
+    http_server.shutdown()
+    http_server.server_close()
+
+@pytest.fixture
+def parses(monkeypatch):
+    # The tests fetch by hand, and count the calendars parsed
+    monkeypatch.setattr(cal.cal, 'start', lambda self: None)
+
+    counts = [0]
+    parse_calendar = cal._parse_calendar
+    def counting(lines):
+        counts[0] += 1
+        return parse_calendar(lines)
+    monkeypatch.setattr(cal, '_parse_calendar', counting)
+    return counts
+
+def make_cal(server, cache_dir):
+    return cal.cal({'cache_dir': str(cache_dir), 'web': {'calendar': server.url, 'color': 'red'}})
+
+# One fetch, as the fetcher thread does it
+def fetch(calendars, name):
+    future = Future()
+    try:
+        future.set_result(calendars._get_calendar(name))
+    except Exception as e:
+        future.set_exception(e)
+    calendars._store_calendar(name, future)
+
+def summaries(calendars):
+    return [event.name for (_, event) in calendars.get_events()]
+
+def test_etag_and_cache(server, parses, tmp_path):
+    cache_dir = tmp_path / 'cache'
+
+    calendars = make_cal(server, cache_dir)
+    assert calendars.calendar_data == dict()
+
+    fetch(calendars, 'web')
+    assert server.requests == [None]
+    assert parses[0] == 1
+    assert calendars.validators['web'] == {'etag': '"v1"'}
+    assert sorted(os.listdir(cache_dir)) == sorted(f'{cal.md5(server.url.encode("utf-8")).hexdigest()}.{extension}'
+        for extension in ['ics', 'json', 'pickle'])
+    snapshot = calendars.calendar_data['web']
+    assert not snapshot.error
+    assert summaries(calendars) == ['First']
+
+    # Unchanged: a 304, nothing parsed and the same calendar kept
+    fetch(calendars, 'web')
+    assert server.requests == [None, '"v1"']
+    assert parses[0] == 1
+    assert calendars.calendar_data['web'].data is snapshot.data
+    assert not calendars.has_error()
+
+    # A restart shows the cached calendar before fetching, and asks with
+    # the cached ETag
+    restarted = make_cal(server, cache_dir)
+    assert restarted.validators['web'] == {'etag': '"v1"'}
+    assert summaries(restarted) == ['First']
+    assert len(server.requests) == 2
+
+    fetch(restarted, 'web')
+    assert server.requests[-1] == '"v1"'
+    assert parses[0] == 1
+    assert summaries(restarted) == ['First']
+
+    # Changed: fetched, parsed and cached again
+    server.body = make_calendar('Second')
+    server.etag = '"v2"'
+    fetch(restarted, 'web')
+    assert server.requests[-1] == '"v1"'
+    assert parses[0] == 2
+    assert restarted.validators['web'] == {'etag': '"v2"'}
+    assert summaries(restarted) == ['Second']
+    assert make_cal(server, cache_dir).validators['web'] == {'etag': '"v2"'}
@@ -0,0 +1,81 @@
+from concurrent.futures import Future
+from datetime import date, timedelta
+import logging
+import random
+import threading
+import time
+
+import icalendar
+
+from cal import cal
+
+STRESS_SECONDS = 2
+READERS = 4
+
+def make_calendar(summaries):
+    today = date.today()
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//today//tests//EN']
+    for (index, summary) in enumerate(summaries):
+        start = today + timedelta(days=index % cal.WINDOW_DAYS)
+        lines += ['BEGIN:VEVENT', f'UID:{summary}@tests', f'SUMMARY:{summary}',
+            f'DTSTART:{start.strftime("%Y%m%d")}T{9 + index % 8:02d}0000Z',
+            f'DTEND:{start.strftime("%Y%m%d")}T{10 + index % 8:02d}0000Z', 'END:VEVENT']
+    lines += ['BEGIN:VEVENT', 'UID:all-day@tests', 'SUMMARY:All day',
+        f'DTSTART;VALUE=DATE:{today.strftime("%Y%m%d")}',
+        f'DTEND;VALUE=DATE:{(today + timedelta(days=2)).strftime("%Y%m%d")}', 'END:VEVENT', 'END:VCALENDAR']
+    return '\r\n'.join(lines) + '\r\n'
+
+# Publish new calendars and failures as fast as possible while readers call
+# get_events and has_error, which take no lock
+def test_readers_during_publishing(tmp_path, monkeypatch):
+    monkeypatch.setattr(cal.cal, 'start', lambda self: None)
+
+    source = tmp_path / 'calendar.ics'
+    source.write_text(make_calendar(['Start']))
+    calendars = cal.cal({'cache_dir': str(tmp_path / 'cache'),
+        'a': {'calendar': str(source), 'color': 'red'},
+        'b': {'calendar': str(source), 'color': 'blue'}})
+
+    versions = [icalendar.Calendar.from_ical(make_calendar([f'Event {version} {index}' for index in range(version + 1)]))
+        for version in range(5)]
+
+    stop = threading.Event()
+    errors = []
+    counts = {'published': 0, 'read': 0}
+
+    def writer():
+        while not stop.is_set():
+            future = Future()
+            if random.random() < 0.3:
+                future.set_exception(RuntimeError('fetch failed'))
+            else:
+                future.set_result(random.choice(versions))
+            calendars._store_calendar(random.choice(['a', 'b']), future)
+            counts['published'] += 1
+
+    def reader():
+        while not stop.is_set():
+            try:
+                events = calendars.get_events()
+                calendars.has_error()
+                days = [day for (day, _) in events]
+                assert days == sorted(days)
+                counts['read'] += 1
+            except Exception as e:
+                errors.append(e)
+
+    logging.disable(logging.CRITICAL)
+    try:
+        threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader) for _ in range(READERS)]
+        for thread in threads:
+            thread.start()
+        time.sleep(STRESS_SECONDS)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        logging.disable(logging.NOTSET)
+
+    assert errors == []
+    assert counts['published'] > 0
+    assert counts['read'] > 0
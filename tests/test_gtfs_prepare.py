@@ -0,0 +1,66 @@
+import sqlite3
+
+import pytest
+
+from gtfs import gtfs
+
+# A stop_times table as a user might have made it, with a text
+# stop_sequence and constraints, indexes, triggers and a view of their own
+SCHEMA = '''
+    CREATE TABLE trips (trip_id TEXT PRIMARY KEY, route_id TEXT, service_id TEXT, trip_headsign TEXT);
+    CREATE TABLE stop_times (trip_id TEXT NOT NULL REFERENCES trips (trip_id) ON DELETE CASCADE,
+        arrival_time TEXT, departure_time TEXT, stop_id TEXT NOT NULL DEFAULT 'none', stop_sequence TEXT NOT NULL,
+        PRIMARY KEY (trip_id, stop_sequence), UNIQUE (trip_id, departure_time), CHECK (stop_id <> ''));
+    CREATE INDEX stop_times_arrival ON stop_times (arrival_time);
+    CREATE TABLE inserted (stop_sequence);
+    CREATE TRIGGER stop_times_insert AFTER INSERT ON stop_times BEGIN INSERT INTO inserted VALUES (NEW.stop_sequence); END;
+    CREATE VIEW stop_sequences AS SELECT trip_id, stop_sequence FROM stop_times;
+    INSERT INTO trips VALUES ('T1', 'R1', 'S1', 'Town');
+    INSERT INTO stop_times VALUES ('T1', '10:00:00', '10:00:00', 'A', '2'), ('T1', '10:05:00', '10:05:00', 'B', '10');
+'''
+
+@pytest.fixture
+def db_file(tmp_path):
+    path = str(tmp_path / 'feed.sqlite')
+    con = sqlite3.connect(path)
+    con.executescript(SCHEMA)
+    con.close()
+    return path
+
+def test_rebuild_keeps_definition(db_file, capsys):
+    gtfs.prepare_database(db_file)
+    output = capsys.readouterr().out
+    assert 'converted stop_times.stop_sequence to INTEGER' in output
+    assert 'the CHECK clauses of stop_times were not kept' in output
+
+    con = sqlite3.connect(db_file)
+    try:
+        columns = {column[1]: column for column in con.execute('PRAGMA table_info(stop_times)')}
+        assert columns['stop_sequence'][2] == 'INTEGER'
+        assert columns['trip_id'][3] == 1
+        assert columns['stop_id'][4] == "'none'"
+        assert [columns['trip_id'][5], columns['stop_sequence'][5]] == [1, 2]
+
+        assert con.execute('PRAGMA foreign_key_list(stop_times)').fetchall()[0][2:7] == ('trips', 'trip_id', 'trip_id', 'NO ACTION', 'CASCADE')
+        assert [index[3] for index in con.execute('PRAGMA index_list(stop_times)')].count('u') == 1
+
+        names = [row[0] for row in con.execute('SELECT name FROM sqlite_master WHERE tbl_name = \'stop_times\' AND sql IS NOT NULL')]
+        assert 'stop_times_arrival' in names and 'stop_times_insert' in names
+
+        # The view sees the new table, in integer order
+        assert con.execute('SELECT stop_sequence FROM stop_sequences ORDER BY stop_sequence').fetchall() == [(2,), (10,)]
+
+        con.execute('INSERT INTO stop_times (trip_id, stop_sequence) VALUES (\'T1\', \'3\')')
+        assert con.execute('SELECT stop_id FROM stop_times WHERE stop_sequence = 3').fetchone() == ('none',)
+        assert con.execute('SELECT stop_sequence FROM inserted').fetchall()[-1] == (3,)
+        with pytest.raises(sqlite3.IntegrityError):
+            con.execute('INSERT INTO stop_times (trip_id, stop_sequence) VALUES (\'T1\', 2)')
+    finally:
+        con.close()
+
+def test_prepared_database_left_alone(db_file, capsys):
+    gtfs.prepare_database(db_file)
+    capsys.readouterr()
+
+    gtfs.prepare_database(db_file)
+    assert 'converted' not in capsys.readouterr().out
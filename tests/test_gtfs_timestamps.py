@@ -0,0 +1,25 @@
+import pandas as pd
+import pytest
+
+from gtfs import gtfs
+
+# make_timestamps must give the same timestamps as make_timestamp, which
+# it replaced for whole query results
+def expected(date_strs, time_strs):
+    return [gtfs.make_timestamp(date_str, time_str) for (date_str, time_str) in zip(date_strs, time_strs)]
+
+@pytest.mark.parametrize('date_strs,time_strs', [
+    (['20240115', '20240115', '20240115'], ['00:00:00', '12:34:56', '23:59:59']),
+    # Past midnight on the service day
+    (['20240115', '20240115', '20240115'], ['24:00:00', '25:30:15', '47:59:59']),
+    # Rolling over the end of a month, a leap February and a year
+    (['20240131', '20240229', '20230228', '20241231'], ['24:10:00', '26:00:00', '24:00:01', '47:00:00']),
+])
+def test_matches_make_timestamp(date_strs, time_strs):
+    result = gtfs.make_timestamps(pd.Series(date_strs), pd.Series(time_strs))
+    assert list(result) == expected(date_strs, time_strs)
+
+def test_empty():
+    result = gtfs.make_timestamps(pd.Series([], dtype=object), pd.Series([], dtype=object))
+    assert len(result) == 0
+    assert result.dtype == 'datetime64[ns]'
@@ -0,0 +1,189 @@
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import threading
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+import pytest
+
+from rtm import rtm
+
+# A stand-in for the RTM REST API, holding tasks keyed by
+# (list ID, taskseries ID, task ID). Like RTM it gives a single item in
+# place of a one item list and leaves out empty lists, and with last_sync
+# only returns tasks changed since then.
+class fake_rtm:
+    def __init__(self):
+        self.lists = [{'id': '1', 'name': 'Inbox'}, {'id': '2', 'name': 'Work'}]
+        self.tasks = dict()
+        self.requests = []
+        self.failing = False
+
+    def put(self, key, **fields):
+        entry = self.tasks.get(key, {'name': '', 'due': '', 'completed': '', 'deleted': ''})
+        entry.update(fields)
+        entry['modified'] = time.time()
+        self.tasks[key] = entry
+
+    def move(self, key, list_id):
+        entry = self.tasks.pop(key)
+        entry['modified'] = time.time()
+        self.tasks[(list_id,) + key[1:]] = entry
+
+    def respond(self, params):
+        self.requests.append(params)
+        if params['method'] == 'rtm.lists.getList':
+            return {'rsp': {'stat': 'ok', 'lists': {'list': self.lists}}}
+
+        since = None
+        if 'last_sync' in params:
+            since = datetime.strptime(params['last_sync'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp()
+
+        lists = dict()
+        for ((list_id, series_id, task_id), entry) in self.tasks.items():
+            if since is not None and entry['modified'] < since:
+                continue
+            if 'filter' in params and (entry['completed'] or entry['deleted']):
+                continue
+
+            task_list = lists.setdefault(list_id, {'id': list_id})
+            if entry['deleted']:
+                series = {'id': series_id, 'task': {'id': task_id, 'deleted': entry['deleted']}}
+                task_list.setdefault('deleted', {'taskseries': []})['taskseries'].append(series)
+            else:
+                series = {'id': series_id, 'name': entry['name'], 'task': {'id': task_id, 'due': entry['due'],
+                    'completed': entry['completed'], 'deleted': ''}}
+                task_list.setdefault('taskseries', []).append(series)
+
+        for task_list in lists.values():
+            if len(task_list.get('taskseries', [])) == 1:
+                task_list['taskseries'] = task_list['taskseries'][0]
+            if 'deleted' in task_list and len(task_list['deleted']['taskseries']) == 1:
+                task_list['deleted']['taskseries'] = task_list['deleted']['taskseries'][0]
+
+        task_lists = list(lists.values())
+        tasks = dict() if len(task_lists) == 0 else {'list': task_lists[0] if len(task_lists) == 1 else task_lists}
+        return {'rsp': {'stat': 'ok', 'tasks': tasks}}
+
+@pytest.fixture
+def server():
+    api = fake_rtm()
+
+    class handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if api.failing:
+                self.send_response(500)
+                self.end_headers()
+                return
+
+            body = json.dumps(api.respond(dict(parse_qsl(urlsplit(self.path).query)))).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    http_server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    api.url = f'http://127.0.0.1:{http_server.server_address[1]}/services/rest/?'
+    yield api
+    http_server.shutdown()
+    http_server.server_close()
+
+@pytest.fixture(autouse=True)
+def no_thread(monkeypatch):
+    # The tests drive the syncs themselves, without the rate limit
+    monkeypatch.setattr(rtm.rtm, 'start', lambda self: None)
+    monkeypatch.setattr(rtm, 'limiter', rtm.token_bucket(1000, 1000))
+    monkeypatch.setattr(rtm, 'SYNC_OVERLAP', 0)
+
+def make_rtm(server, cache_file):
+    instance = rtm.rtm({'api_key': 'key', 'shared_secret': 'secret', 'token': 'token',
+        'required_lists': ['Work'], 'url': server.url, 'cache_file': str(cache_file)})
+    instance._get_lists()
+    return instance
+
+def due(days):
+    return (date.today() + timedelta(days=days)).isoformat() + 'T12:00:00Z'
+
+# Wait until changes are newer than the last sync, which is in whole seconds
+def next_second():
+    time.sleep(1.1)
+
+def test_incremental_matches_full(server, tmp_path):
+    for index in range(6):
+        server.put(('1', f'series{index}', 'task'), name=f'Task {index}', due=due(index - 2))
+    server.put(('2', 'work', 'task'), name='Work task', due=due(0))
+    server.put(('2', 'undated', 'task'), name='No due date')
+
+    instance = make_rtm(server, tmp_path / 'rtm.json')
+    instance._fetch_tasks()
+    assert 'filter' in server.requests[-1]
+    assert len(instance.store) == 7
+
+    # A single change comes back as a single list, taskseries and task
+    next_second()
+    server.put(('1', 'series0', 'task'), completed=due(0))
+    instance._fetch_tasks()
+    assert 'last_sync' in server.requests[-1] and 'filter' not in server.requests[-1]
+    assert ('1', 'series0', 'task') not in instance.store
+
+    next_second()
+    server.put(('1', 'series1', 'task'), deleted=due(0))
+    server.put(('1', 'series2', 'task'), name='Renamed')
+    server.put(('1', 'series4', 'task'), due='')
+    server.move(('1', 'series3', 'task'), '2')
+    server.put(('2', 'undated', 'task'), due=due(1))
+    server.put(('1', 'new', 'task'), name='New task', due=due(2))
+    instance._fetch_tasks()
+    assert 'last_sync' in server.requests[-1]
+
+    # Nothing changed since
+    next_second()
+    instance._fetch_tasks()
+
+    fresh = make_rtm(server, tmp_path / 'fresh.json')
+    fresh._fetch_tasks()
+    assert instance.store == fresh.store
+    assert instance.get_tasks(None) == fresh.get_tasks(None)
+    assert instance.get_tasks('Work') == fresh.get_tasks('Work')
+    assert [entry['name'] for entry in instance.get_tasks('Work')] == ['Work task', 'No due date', 'Task 3']
+
+def test_failed_full_fetch_keeps_cache(server, tmp_path):
+    server.put(('1', 'series', 'task'), name='Cached task', due=due(0))
+    server.put(('2', 'work', 'task'), name='Work task', due=due(1))
+
+    first = make_rtm(server, tmp_path / 'rtm.json')
+    first._fetch_tasks()
+    assert len(first.store) == 2
+
+    # The next run starts from the cache, and its first fetch fails
+    server.failing = True
+    logging.disable(logging.CRITICAL)
+    try:
+        second = rtm.rtm({'api_key': 'key', 'shared_secret': 'secret', 'token': 'token',
+            'required_lists': ['Work'], 'url': server.url, 'cache_file': str(tmp_path / 'rtm.json')})
+        assert second.is_stale()
+        assert second.store == first.store
+
+        second._fetch_tasks()
+    finally:
+        logging.disable(logging.NOTSET)
+
+    assert second.store == first.store
+    assert second.is_stale()
+    assert second.get_tasks(None) == first.get_tasks(None)
+    assert second.get_tasks('Work') == first.get_tasks('Work')
+
+    # Once the server is back a full fetch replaces the store
+    server.failing = False
+    second._fetch_tasks()
+    assert 'filter' in server.requests[-1]
+    assert not second.is_stale()
+    assert second.store == first.store
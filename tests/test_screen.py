@@ -0,0 +1,57 @@
+import io
+
+from blessed import Terminal
+
+from screen import screen
+
+def make_screen(width, height):
+    term = Terminal(kind='xterm-256color', force_styling=True)
+    stream = io.StringIO()
+    display = screen.screen(term, stream)
+    display.resize(width, height)
+    return (term, stream, display)
+
+def cells(display, y):
+    return [char for (char, _) in display.back[y]]
+
+def test_double_width_takes_two_cells():
+    (_, _, display) = make_screen(8, 1)
+    display.write(0, 0, 'a中b')
+    assert cells(display, 0) == ['a', '中', screen.CONTINUATION, 'b', ' ', ' ', ' ', ' ']
+
+def test_zero_width_joins_previous():
+    (_, _, display) = make_screen(4, 1)
+    display.write(0, 0, 'éx')
+    assert cells(display, 0) == ['é', 'x', ' ', ' ']
+
+def test_clipped_at_edges():
+    (_, _, display) = make_screen(4, 1)
+    display.write(-1, 0, '中ab中')
+    assert cells(display, 0) == [' ', 'a', 'b', ' ']
+
+def test_overwriting_half_blanks_the_rest():
+    (_, _, display) = make_screen(4, 1)
+    display.write(0, 0, '中中')
+    display.write(1, 0, 'x')
+    assert cells(display, 0) == [' ', 'x', '中', screen.CONTINUATION]
+
+# A change to only the second half of a double width character has to
+# send the whole character again
+def test_flush_resends_whole_character():
+    (term, stream, display) = make_screen(6, 1)
+    display.write(0, 0, 'ab中d')
+    display.flush()
+
+    display.write(0, 0, 'ab中d')
+    display.back[0][3] = (screen.CONTINUATION, 'style')
+    position = stream.tell()
+    display.flush()
+    assert stream.getvalue()[position:].startswith(term.move_xy(2, 0))
+
+def test_unchanged_wide_text_sends_nothing():
+    (_, stream, display) = make_screen(10, 1)
+    for _ in range(2):
+        display.write(0, 0, '任务 😀 done')
+        position = stream.tell()
+        display.flush()
+    assert stream.getvalue()[position:] == ''